@@ -2,6 +2,8 @@ from typing import Union, Literal
 from functools import reduce
 
 from api import *
+import tracing
+from log import summarize
 from utils import MkIXMessageMemo, CQCode, RequestMemo, Tools
 from model import OB11ActionData, MkIXPostMessage, CQDataListItem, CQData, MkIXMessagePayload
 
@@ -105,6 +107,24 @@ class DeleteMsg(HTTPAction):
         return model_list
 
 
+class RevokeBatch(dict):
+    """ message_id -> 撤回请求，或无法撤回的原因 """
+    pass
+
+
+class DeleteMsgBatch(HTTPAction):
+    _message_ids: list
+
+    async def __call__(self) -> RevokeBatch:
+        batch = RevokeBatch()
+        for i in self._message_ids:
+            try:
+                batch[str(i)] = await DeleteMsg(message_id=str(i))()
+            except KeyError as e:
+                batch[str(i)] = e.args[0] if e.args else str(e)
+        return batch
+
+
 class SetGroupKick(HTTPAction):
     _group_id: str
     _user_id: str
@@ -257,6 +277,18 @@ class GetGroupMemberInfo(HTTPAction):
         }
 
 
+class GetGroupMemberInfoBatch(HTTPAction):
+    _group_id: str
+    _user_ids: list
+
+    async def __call__(self):
+        return {
+            "cls": GroupMemberInfoBatch,
+            "group_id": self._group_id,
+            "user_ids": self._user_ids,
+        }
+
+
 class GetGroupMemberList(HTTPAction):
     _group_id: str
 
@@ -347,39 +379,44 @@ class SendPrivateForwardMsg(MessageAction):
             i.groupType = "friend"
 
 
-async def action_mapping(data: OB11ActionData) -> Union[list[MkIXPostMessage], dict]:
-    Tools.logger().info(f'Receive OB11 message: {data}')
+ACTIONS = {
+    "send_private_msg": SendPrivateMsg,
+    "send_group_msg": SendGroupMsg,
+    "send_msg": SendMsg,
+    "delete_msg": DeleteMsg,
+    "delete_msg_batch": DeleteMsgBatch,
+    "set_group_kick": SetGroupKick,
+    "set_group_ban": SetGroupBan,
+    "set_group_admin": SetGroupAdmin,
+    "set_group_name": SetGroupName,
+    "set_group_leave": SetGroupLeave,
+    "set_friend_add_request": SetFriendAddRequest,
+    "set_group_add_request": SetGroupAddRequest,
+    "get_login_info": GetLoginInfo,
+    "get_stranger_info": GetStrangerInfo,
+    "get_friend_list": GetFriendList,
+    "get_group_info": GetGroupInfo,
+    "get_group_list": GetGroupList,
+    "get_group_member_info": GetGroupMemberInfo,
+    "get_group_member_info_batch": GetGroupMemberInfoBatch,
+    "get_group_member_list": GetGroupMemberList,
+    "get_record": GetRecord,
+    "get_image": GetImage,
+    "get_status": GetStatus,
+    "get_version_info": GetVersionInfo,
+
+    "send_group_forward_msg": SendGroupForwardMsg,
+    "send_private_forward_msg": SendPrivateForwardMsg,
+}
+
+
+@tracing.traced("action_mapping")
+async def action_mapping(data: OB11ActionData) -> Union[list[MkIXPostMessage], RevokeBatch, dict]:
+    Tools.logger().info('Receive OB11 message: %s', summarize(data))
     action = data.action
-    actions = {
-        "send_private_msg": SendPrivateMsg,
-        "send_group_msg": SendGroupMsg,
-        "send_msg": SendMsg,
-        "delete_msg": DeleteMsg,
-        "set_group_kick": SetGroupKick,
-        "set_group_ban": SetGroupBan,
-        "set_group_admin": SetGroupAdmin,
-        "set_group_name": SetGroupName,
-        "set_group_leave": SetGroupLeave,
-        "set_friend_add_request": SetFriendAddRequest,
-        "set_group_add_request": SetGroupAddRequest,
-        "get_login_info": GetLoginInfo,
-        "get_stranger_info": GetStrangerInfo,
-        "get_friend_list": GetFriendList,
-        "get_group_info": GetGroupInfo,
-        "get_group_list": GetGroupList,
-        "get_group_member_info": GetGroupMemberInfo,
-        "get_group_member_list": GetGroupMemberList,
-        "get_record": GetRecord,
-        "get_image": GetImage,
-        "get_status": GetStatus,
-        "get_version_info": GetVersionInfo,
-
-        "send_group_forward_msg": SendGroupForwardMsg,
-        "send_private_forward_msg": SendPrivateForwardMsg,
-    }
-    if action not in actions:
+    if action not in ACTIONS:
         raise ValueError(f"Unsupported Action: {action}")
 
-    operation = actions[action](**data.params)
+    operation = ACTIONS[action](**data.params)
     return await operation()
 
@@ -1,24 +1,63 @@
 import re
 import os
 import json
+import time
 import uuid
 import base64
 import asyncio
 import aiofiles
 from abc import ABC, abstractmethod
+from contextvars import ContextVar
 from typing import Type, Optional, Union
 
 import httpx
 
+import metrics
+import tracing
 from model import Config
+from ratelimit import RateLimiter
+from members import MemberIndex, member_info, MEMBER, ADMIN, OWNER
 
 DEVICE = "00000000"
+TOKEN_TTL = 30 * 60         # 无法得知token过期时间时使用，单位: s
+TOKEN_REFRESH_AHEAD = 60    # 在过期前多久刷新，单位: s
+
+_clients: dict[bool, httpx.AsyncClient] = {}    # ssl_check -> 连接池，所有账号共用
+
+
+def _client(verify: bool) -> httpx.AsyncClient:
+    if verify not in _clients:
+        _clients[verify] = httpx.AsyncClient(verify=verify)
+    return _clients[verify]
+
+
+async def close_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    await asyncio.gather(*[i.aclose() for i in clients])
+
+
+class UnauthorizedError(RuntimeError):
+    """ 401/403，token无效或已过期 """
+    pass
+
+
+class TooManyRequestsError(RuntimeError):
+    """ 429，服务器限流 """
+    pass
 
 
 class API(ABC):
+    _requires_token = True
 
-    def __init__(self, config: Config):
+    @classmethod
+    def cached(cls, kwargs: dict) -> bool:
+        """ 可直接由本地缓存返回，无需访问Mk.IX """
+        return False
+
+    def __init__(self, config: Config, token_manager: Optional['TokenManager'] = None):
         self._config = config
+        self._token_manager = token_manager
 
     def _build_url(self, endpoint: str, **params):
         query = '&'.join(f"{k}={v}" for k, v in params.items())
@@ -27,7 +66,11 @@ class API(ABC):
     def _response_handler(self, res: httpx.Response) -> dict:
         if res.status_code >= 500:
             raise RuntimeError(f"MkIX Server Error {res.status_code}")
+        if res.status_code == 429:
+            raise TooManyRequestsError("HTTP 429")
         content = json.loads(res.content.decode())
+        if res.status_code in (401, 403):
+            raise UnauthorizedError(f"HTTP {res.status_code} detail={content['detail']}")
         if res.status_code >= 300:
             raise RuntimeError(f"HTTP {res.status_code} detail={content['detail']}")
         return content
@@ -53,9 +96,14 @@ class API(ABC):
             "timeout": timeout,
         }
 
-        verify = self._config.ssl_check
-        async with httpx.AsyncClient(verify=verify) as client:
+        client = _client(self._config.ssl_check)
+        with tracing.span("API._fetch", api=type(self).__name__, method=kwargs["method"]) as span:
             res = await client.request(**kwargs)
+            # token失效时刷新并重试一次
+            if res.status_code == 401 and self._token_manager and headers and "Authorization" in headers:
+                headers["Authorization"] = await self._token_manager.refresh(stale=headers["Authorization"])
+                res = await client.request(**kwargs)
+            span["status"] = res.status_code
         return res
 
     @abstractmethod
@@ -64,6 +112,7 @@ class API(ABC):
 
 
 class Login(API):
+    _requires_token = False
 
     async def __call__(self, *args, **kwargs):
         res = await self._fetch(
@@ -291,111 +340,94 @@ class GroupList(API):
         } for i in ret["groups"]]
 
 
-class GroupMemberInfo(API):
+async def _load_members(api: API, group_id: str) -> dict[str, int]:
+    """ 拉取群成员与管理员，返回 成员 -> 角色 """
+    res0, res1 = await asyncio.gather(
+        api._fetch(
+            "GET",
+            api._build_url(f'v1/group/{group_id}/members'),
+            headers={"Authorization": api._config.token}
+        ),
+        api._fetch(
+            "GET",
+            api._build_url(f'v1/group/{group_id}/members/admin'),
+            headers={"Authorization": api._config.token}
+        ),
+    )
+    ret0, ret1 = api._response_handler(res0), api._response_handler(res1)
+    roles = {i["uuid"]: MEMBER for i in ret0["members"]}
+    roles.update((i["uuid"], ADMIN) for i in ret1["admin"])
+    roles[ret1["owner"]["uuid"]] = OWNER
+    return roles
+
+
+class _MemberLookup(API):
+
+    @classmethod
+    def cached(cls, kwargs: dict) -> bool:
+        return MemberIndex.get_instance().get(kwargs["group_id"]) is not None
+
+    async def _roles(self, group_id: str) -> dict[str, int]:
+        return await MemberIndex.get_instance().roles(group_id, lambda: _load_members(self, group_id))
+
+
+class GroupMemberInfo(_MemberLookup):
 
     async def __call__(self, *args, **kwargs):
         group_id, user_id = kwargs["group_id"], kwargs["user_id"]
-        res = await self._fetch(
-            "GET",
-            self._build_url(f'v1/group/{group_id}/members/admin'),
-            headers={"Authorization": self._config.token}
-        )
-        ret = self._response_handler(res)
-        if user_id in [i["uuid"] for i in ret["admin"]]:
-            role = "admin"
-        elif user_id == ret["owner"]["uuid"]:
-            role = "owner"
-        else:
-            role = "member"
-        return {
-            "group_id": group_id,
-            "user_id": user_id,
-            "nick_name": "",
-            "card": "",
-            "sex": "",
-            "age": -1,
-            "area": "",
-            "join_time": -1,
-            "last_sent_time": -1,
-            "level": "",
-            "role": role,
-            "unfriendly": "",
-            "title": "",
-            "title_expire_time": -1,
-            "card_changeable": False,
-        }
+        roles = await self._roles(group_id)
+        return member_info(group_id, user_id, roles.get(str(user_id), MEMBER))
 
 
-class GroupMemberList(API):
+class GroupMemberInfoBatch(_MemberLookup):
 
     async def __call__(self, *args, **kwargs):
-        group_id = kwargs["group_id"]
-        res0 = await self._fetch(
-            "GET",
-            self._build_url(f'v1/group/{group_id}/members'),
-            headers={"Authorization": self._config.token}
-        )
-        ret0 = self._response_handler(res0)
-        res1 = await self._fetch(
-            "GET",
-            self._build_url(f'v1/group/{group_id}/members/admin'),
-            headers={"Authorization": self._config.token}
-        )
-        ret1 = self._response_handler(res1)
-        admins = {i["uuid"] for i in ret1["admin"]}
-        owner = ret1["owner"]["uuid"]
+        group_id, user_ids = kwargs["group_id"], kwargs["user_ids"]
+        roles = await self._roles(group_id)
+        return [member_info(group_id, i, roles.get(str(i), MEMBER)) for i in user_ids]
 
-        return [{
-            "group_id": group_id,
-            "user_id": i["uuid"],
-            "nick_name": "",
-            "card": "",
-            "sex": "",
-            "age": -1,
-            "area": "",
-            "join_time": -1,
-            "last_sent_time": -1,
-            "level": "",
-            "role": "admin" if i["uuid"] in admins else "owner" if i["uuid"] == owner else "member",
-            "unfriendly": "",
-            "title": "",
-            "title_expire_time": -1,
-            "card_changeable": False,
-        } for i in ret0["members"]]
+
+class GroupMemberList(_MemberLookup):
+
+    async def __call__(self, *args, **kwargs):
+        group_id = kwargs["group_id"]
+        roles = await self._roles(group_id)
+        return [member_info(group_id, k, v) for k, v in roles.items()]
 
 
 class Status(API):
+    _requires_token = False
 
     async def __call__(self, *args, **kwargs):
-        status = await self._config.ws_check()
-        return {
-            "online": status,
-            "good": status,
-        }
+        ret = self._config.ws_check()
+        if kwargs.get("stat", True):
+            ret["stat"] = metrics.REGISTRY.summary()
+        return ret
 
 
 class GetFriendRequest(API):
 
     async def __call__(self, *args, **kwargs):
-        asyncio.create_task(self._fetch(
+        await self._fetch(
             "GET",
             self._build_url(f'v1/user/{self._config.account}/verify/request', device=DEVICE),
             headers={"Authorization": self._config.token}
-        ))
+        )
 
 
 class GetGroupRequest(API):
 
     async def __call__(self, *args, **kwargs):
         group = kwargs["group"]
-        asyncio.create_task(self._fetch(
+        await self._fetch(
             "GET",
             self._build_url(f'v1/group/{group}/verify/request', device=DEVICE),
             headers={"Authorization": self._config.token}
-        ))
+        )
 
 
 class VersionInfo(API):
+    _requires_token = False
 
     async def __call__(self, *args, **kwargs):
         return {
@@ -447,6 +479,7 @@ class Record(APIWithFileIO):
 
 
 class Image(APIWithFileIO):
+    _requires_token = False
 
     async def __call__(self, *args, **kwargs):
         file = kwargs["file"]  # base64
@@ -469,20 +502,83 @@ class Image(APIWithFileIO):
         return {"file": absolute_path}
 
 
+def jwt_expire(token: str) -> Optional[float]:
+    """ 读取JWT中的exp，不校验签名，不是JWT时返回None """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
+
+class TokenManager:
+    """ 记录token的过期时间，过期前自动刷新 """
+
+    def __init__(self, config: Config):
+        self._config = config
+        self._expire = 0.0
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def get(self) -> str:
+        if time.time() >= self._expire - TOKEN_REFRESH_AHEAD:
+            metrics.CACHE.inc("token", "miss")
+            return await self.refresh()
+        metrics.CACHE.inc("token", "hit")
+        return self._config.token
+
+    async def refresh(self, stale: Optional[str] = None) -> str:
+        # 已被其他请求刷新
+        if stale is not None and stale != self._config.token:
+            return self._config.token
+        # 并发的刷新合并为一次请求
+        if self._refreshing is None:
+            self._refreshing = asyncio.create_task(self._login())
+            self._refreshing.add_done_callback(lambda _: setattr(self, "_refreshing", None))
+        await asyncio.shield(self._refreshing)
+        return self._config.token
+
+    async def _login(self) -> None:
+        res = await Login(self._config)()
+        token = res['access_token']
+        self._config.token = f"Bearer {token}"
+        self._expire = jwt_expire(token) or time.time() + res.get("expires_in", TOKEN_TTL)
+
+
 class FetchAPI:
-    _instance = None
+    _instance: ContextVar[Optional['FetchAPI']] = ContextVar("FetchAPI", default=None)    # 每个账号一个
 
     def __init__(self, config: Config):
-        if FetchAPI._instance is not None:
+        if FetchAPI._instance.get() is not None:
             raise ValueError("Already instantiated")
         self._config = config
-        FetchAPI._instance = self
+        self._token_manager = TokenManager(config)
+        self._rate_limiter = RateLimiter(config.rate_limit)
+        FetchAPI._instance.set(self)
 
     @classmethod
     def get_instance(cls) -> 'FetchAPI':
-        if cls._instance is None:
+        instance = cls._instance.get()
+        if instance is None:
             raise ValueError("Not instantiated yet")
-        return cls._instance
+        return instance
+
+    @property
+    def token_manager(self) -> TokenManager:
+        return self._token_manager
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._rate_limiter
 
     async def call(self, cls: Type[API], **kwargs) -> Optional[Union[dict, httpx.Response]]:
-        return await cls(self._config)(**kwargs)
+        if cls._requires_token and not cls.cached(kwargs):
+            await self._token_manager.get()
+        try:
+            with metrics.HTTP_LATENCY.time(cls.__name__):
+                return await cls(self._config, self._token_manager)(**kwargs)
+        except Exception as e:
+            metrics.HTTP_ERRORS.inc(cls.__name__)
+            if isinstance(e, TooManyRequestsError):
+                self._rate_limiter.throttle(kwargs.get("group_id", kwargs.get("group")))
+            raise
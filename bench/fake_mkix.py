@@ -0,0 +1,161 @@
+""" 本地的Mk.IX服务器替身，实现Mk.XI用到的HTTP接口与WebSocket echo，所有响应可附加固定延迟 """
+import json
+import time
+import base64
+import asyncio
+from typing import Optional
+
+from aiohttp import web, WSMsgType
+
+ACCOUNT = "1234567890"
+
+
+class FakeMkIX:
+
+    def __init__(self, latency: float = 0.0, groups: tuple[str, ...] = ("100",), friends: tuple[str, ...] = ("200",)):
+        self.latency = latency
+        self.groups = list(groups)
+        self.friends = list(friends)
+        self.received: list[dict] = []      # Mk.XI发送的消息
+        self.uploads = 0
+        self.connected = asyncio.Event()
+        self._ws: set[web.WebSocketResponse] = set()
+        self._last_time = 0
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application(client_max_size=64 << 20, middlewares=[self._delay])
+        self.app.add_routes([
+            web.post("/v1/user/token", self._token),
+            web.get("/v1/user/wsToken", self._ws_token),
+            web.get("/v1/user/profile/me", self._profile_me),
+            web.get("/v1/user/{uuid}/profile", self._profile),
+            web.get("/v1/user/{uuid}/verify/request", self._empty),
+            web.get("/v1/group/{group}/verify/request", self._empty),
+            web.get("/v1/group/{group}/info", self._group_info),
+            web.get("/v1/group/{group}/members", self._members),
+            web.get("/v1/group/{group}/members/admin", self._admins),
+            web.post("/v1/{group_type}/{group}/upload", self._upload),
+            web.get("/v1/{group_type}/{group}/download/{file}", self._download),
+            web.get("/websocket/connect", self._websocket),
+        ])
+
+    def timestamp(self) -> str:
+        """ 递增且互不相同的13位时间戳，Mk.XI以此作为message_id """
+        self._last_time = max(self._last_time + 1, int(time.time() * 1000))
+        return str(self._last_time)
+
+    async def start(self, host: str, port: int) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self) -> None:
+        for ws in list(self._ws):
+            await ws.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def push(self, count: int, content: str = "hello", group: Optional[str] = None) -> None:
+        """ 向Mk.XI推送count条群聊消息 """
+        group = group or self.groups[0]
+        for _ in range(count):
+            await self.send({
+                "time": self.timestamp(),
+                "type": "text",
+                "group": group,
+                "isSystemMessage": False,
+                "senderID": "bench-user",
+                "payload": {"content": content, "meta": {}},
+            })
+
+    async def send(self, message: dict) -> None:
+        data = json.dumps(message)
+        for ws in self._ws:
+            await ws.send_str(data)
+
+    @web.middleware
+    async def _delay(self, request, handler):
+        if self.latency and request.path != "/websocket/connect":
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def _token(self, request):
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": time.time() + 3600}).encode()).decode().rstrip("=")
+        return web.json_response({"access_token": f"bench.{payload}.sig", "token_type": "bearer"})
+
+    async def _ws_token(self, request):
+        return web.json_response({"token": "bench-ws-token"})
+
+    async def _profile_me(self, request):
+        return web.json_response({
+            "uuid": ACCOUNT,
+            "username": "bench",
+            "bio": "",
+            "lastUpdate": "0",
+            "groups": [{"group": i} for i in self.groups],
+            "friends": [{"uuid": i} for i in self.friends],
+        })
+
+    async def _profile(self, request):
+        return web.json_response({"username": request.match_info["uuid"], "avatar": ""})
+
+    async def _empty(self, request):
+        return web.json_response([])
+
+    async def _group_info(self, request):
+        return web.json_response({"name": f"group {request.match_info['group']}"})
+
+    async def _members(self, request):
+        return web.json_response({
+            "users": [ACCOUNT, "bench-user"],
+            "members": [{"uuid": ACCOUNT}, {"uuid": "bench-user"}],
+        })
+
+    async def _admins(self, request):
+        return web.json_response({"owner": {"uuid": ACCOUNT}, "admin": []})
+
+    async def _upload(self, request):
+        await request.read()
+        self.uploads += 1
+        return web.json_response({"time": self.timestamp()})
+
+    async def _download(self, request):
+        return web.Response(body=b"\0" * 1024, content_type="application/octet-stream")
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse(max_msg_size=1 << 23)
+        await ws.prepare(request)
+        self._ws.add(ws)
+        self.connected.set()
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                self.received.append(message)
+                asyncio.create_task(self._echo(ws, message))
+        finally:
+            self._ws.discard(ws)
+        return ws
+
+    async def _echo(self, ws: web.WebSocketResponse, message: dict) -> None:
+        """ 与Mk.IX一致，echo之后向所有连接广播发送的消息 """
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = self.timestamp()
+        await ws.send_str(json.dumps({
+            "time": now,
+            "type": "echo",
+            "isSystemMessage": True,
+            "payload": json.dumps({"echo": message["echo"], "time": now}),
+        }))
+        if message.get("type") == "revokeRequest":
+            return
+        await self.send({
+            "time": now,
+            "type": message.get("type"),
+            "group": message.get("group"),
+            "isSystemMessage": False,
+            "senderID": ACCOUNT,
+            "payload": message.get("payload") or {"content": ""},
+        })
@@ -0,0 +1,75 @@
+""" 本地的OneBot Adapter替身，接收Mk.XI的反向WebSocket连接，发送Action并记录事件 """
+import json
+import time
+import asyncio
+import itertools
+from typing import Optional
+
+import websockets
+
+
+class FakeOneBot:
+
+    def __init__(self):
+        self.events: list[tuple[float, dict]] = []  # (perf_counter, event)
+        self.connected = asyncio.Event()
+        self._message_count = 0
+        self._ws = None
+        self._server = None
+        self._echo = itertools.count()
+        self._pending: dict[int, asyncio.Future] = {}
+        self._waiters: list[tuple[int, asyncio.Future]] = []
+
+    async def start(self, host: str, port: int) -> None:
+        self._server = await websockets.serve(self._handler, host, port, max_size=1 << 23)
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handler(self, ws):
+        self._ws = ws
+        try:
+            async for raw in ws:
+                self._on_message(json.loads(raw))
+        except websockets.ConnectionClosed:
+            pass
+
+    def _on_message(self, data: dict):
+        if "retcode" in data:
+            future = self._pending.pop(data.get("echo"), None)
+            if future and not future.done():
+                future.set_result(data)
+            return
+        self.events.append((time.perf_counter(), data))
+        self._message_count += data.get("post_type") == "message"
+        if data.get("meta_event_type") == "lifecycle":
+            self.connected.set()
+        self._notify()
+
+    def _notify(self):
+        count = self.message_count()
+        for target, future in list(self._waiters):
+            if count >= target and not future.done():
+                future.set_result(None)
+        self._waiters = [i for i in self._waiters if not i[1].done()]
+
+    def message_count(self) -> int:
+        return self._message_count
+
+    async def wait_messages(self, count: int, timeout: Optional[float] = None) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((count, future))
+        self._notify()
+        await asyncio.wait_for(future, timeout)
+
+    async def call(self, action: str, params: dict, timeout: float = 60) -> tuple[float, dict]:
+        """ 返回 (耗时s, 响应) """
+        echo = next(self._echo)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[echo] = future
+        start = time.perf_counter()
+        await self._ws.send(json.dumps({"action": action, "params": params, "echo": echo}))
+        res = await asyncio.wait_for(future, timeout)
+        return time.perf_counter() - start, res
@@ -0,0 +1,64 @@
+""" 冷启动导入耗时，超出预算时返回非0
+
+python bench/import_time.py [--runs 5] [--budget 400]
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_BUDGET_MS = 400  # import mkxi 的预算，单位: ms
+LAZY_MODULES = ("PIL", "Crypto", "rich")  # 应在首次使用时才导入
+
+
+def measure() -> tuple[float, list[tuple[int, str]]]:
+    """ 返回 (mkxi的累计耗时ms, [(自身耗时us, 模块名)]) """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import mkxi"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    total, modules = 0.0, []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((int(self_us), name.strip()))
+        if name.strip() == "mkxi":
+            total = int(cumulative_us) / 1000
+    return total, modules
+
+
+def eager_modules() -> list[str]:
+    code = f"import sys, mkxi; print(','.join(i for i in {LAZY_MODULES!r} if i in sys.modules))"
+    res = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return [i for i in res.stdout.strip().split(",") if i]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args()
+
+    results = [measure() for _ in range(args.runs)]
+    median = statistics.median(i[0] for i in results)
+    print(f"import mkxi: median {median:.1f}ms over {args.runs} runs (budget {args.budget:.0f}ms)")
+    print("slowest modules (self time):")
+    for us, name in sorted(results[-1][1], reverse=True)[:10]:
+        print(f"  {us / 1000:8.1f}ms  {name}")
+
+    failed = False
+    eager = eager_modules()
+    if eager:
+        print(f"FAIL: imported eagerly: {', '.join(eager)}")
+        failed = True
+    if median > args.budget:
+        print("FAIL: over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
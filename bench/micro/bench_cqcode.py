@@ -0,0 +1,38 @@
+import pytest
+
+from model import CQData, CQDataListItem
+from utils import CQCode
+from conftest import chat, run
+
+MESSAGES = {
+    "text": chat(0, "hello world " * 20, meta={"at": ["300", "400"]}),
+    "image": chat(0, "data:image/webp;base64," + "A" * 4096, type="image"),
+    "file": chat(0, "1700000000000", type="file"),
+}
+CQ_STRINGS = {
+    "plain": "hello world " * 20,
+    "mixed": "[CQ:at,qq=300] hi [CQ:face,id=14] how are you [CQ:face,id=76][CQ:at,qq=400] bye",
+    "image": "look [CQ:image,file=base64://" + "iVBORw0KGgo" * 400 + "] nice",
+}
+CQ_ARRAY = [
+    CQDataListItem(type="at", data={"qq": "300"}),
+    CQDataListItem(type="text", data={"text": " hi "}),
+    CQDataListItem(type="face", data={"id": "14"}),
+    CQDataListItem(type="text", data={"text": " how are you"}),
+]
+
+
+@pytest.mark.parametrize("format_type", ["string", "array"])
+@pytest.mark.parametrize("kind", MESSAGES)
+def bench_serialization(benchmark, config, kind, format_type):
+    benchmark(CQCode.serialization, MESSAGES[kind], config, format_type, "group")
+
+
+@pytest.mark.parametrize("kind", CQ_STRINGS)
+def bench_deserialization_string(benchmark, kind):
+    message = CQData(data=CQ_STRINGS[kind])
+    benchmark(lambda: run(CQCode.deserialization(message)))
+
+
+def bench_deserialization_array(benchmark):
+    benchmark(lambda: run(CQCode.deserialization(CQ_ARRAY)))
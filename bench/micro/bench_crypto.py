@@ -0,0 +1,51 @@
+import time
+import asyncio
+
+import pytest
+
+import crypto
+from conftest import image_data_url, GROUP
+
+SIZES = {"text": "hello world " * 10, "image": image_data_url(512)}
+BATCH = 8   # 同时处理的图片数，模拟加密的活跃群
+
+
+@pytest.mark.parametrize("kind", SIZES)
+def bench_encrypt(benchmark, config, kind):
+    benchmark(config.cipher.encrypt_blocking, GROUP, SIZES[kind])
+
+
+@pytest.mark.parametrize("kind", SIZES)
+def bench_decrypt(benchmark, config, kind):
+    content, iv = config.cipher.encrypt_blocking(GROUP, SIZES[kind])
+    benchmark(config.cipher.decrypt_blocking, GROUP, content, iv)
+
+
+@pytest.mark.parametrize("mode", ["inline", "offload"])
+def bench_decrypt_throughput(benchmark, loop, config, monkeypatch, mode):
+    """ 并发解密BATCH张图片，extra_info记录期间事件循环的最大停顿 """
+    if mode == "inline":
+        monkeypatch.setattr(crypto, "CRYPTO_OFFLOAD_SIZE", float("inf"))
+    encrypted = [config.cipher.encrypt_blocking(GROUP, SIZES["image"]) for _ in range(BATCH)]
+    stalls = []
+
+    async def batch():
+        done, stall = False, 0.0
+
+        async def ticker():
+            nonlocal stall
+            last = time.perf_counter()
+            while not done:
+                await asyncio.sleep(0)
+                now = time.perf_counter()
+                stall, last = max(stall, now - last), now
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        await asyncio.gather(*[config.cipher.decrypt(GROUP, c, iv) for c, iv in encrypted])
+        done = True
+        await task
+        stalls.append(stall)
+
+    benchmark(lambda: loop.run_until_complete(batch()))
+    benchmark.extra_info["max_loop_stall_ms"] = round(max(stalls) * 1000, 2)
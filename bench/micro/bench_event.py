@@ -0,0 +1,71 @@
+import itertools
+
+import pytest
+
+import event
+from model import EventFilter, MyProfile
+from conftest import chat, system, run, GROUP, FRIEND
+
+SELF_ID = "1234567890"
+
+
+def _var(**kwargs) -> dict:
+    return {"operator": "300", "id": "400", **kwargs}
+
+
+EVENTS = {
+    "PrivateMessageEvent": lambda: chat(0, "hello world", group=FRIEND),
+    "GroupMessageEvent": lambda: chat(0, "hello world", meta={"at": ["400"]}),
+    "GroupFileUpload": lambda: chat(0, "1700000000000", type="file"),
+    "GroupAdmin": lambda: system("notice", meta={"operation": "group_admin_set", "var": {"id": GROUP}}),
+    "GroupDecrease": lambda: chat(0, "", type="system", meta={"operation": "group_kick", "var": _var()}),
+    "GroupIncrease": lambda: chat(0, "", type="system", meta={"operation": "group_joined", "var": _var(way="request")}),
+    "GroupBan": lambda: chat(0, "", type="system", meta={"operation": "group_ban", "var": _var(duration=60)}),
+    "FriendAdd": lambda: system("notice", meta={"operation": "friend_request_accepted", "var": {"id": "400"}}),
+    "GroupRecall": lambda: chat(0, "", type="revoke", meta={"var": {"sender": "300", "time": "1700000000000"}}),
+    "FriendRecall": lambda: chat(0, "", type="revoke", group=FRIEND, meta={"var": {"time": "1700000000000"}}),
+    "FriendRequest": lambda: system("friend", state="等待审核"),
+    "GroupRequest": lambda: system("join", state="等待审核"),
+}
+
+
+def bench_covers_every_event():
+    subclasses, stack = set(), [event.Event]
+    while stack:
+        for i in stack.pop().__subclasses__():
+            stack.append(i)
+            if not getattr(i, "__abstractmethods__", None) and i.__call__ is not event.Event.__call__:
+                subclasses.add(i.__name__)
+    assert subclasses <= set(EVENTS) | {"LifeCycle", "HeartBeat"}
+
+
+@pytest.mark.parametrize("name", EVENTS)
+def bench_event(benchmark, config, name):
+    cls, message = getattr(event, name), EVENTS[name]()
+    benchmark(lambda: run(cls(message, config, SELF_ID)()))
+
+
+def bench_lifecycle(benchmark):
+    benchmark(lambda: run(event.LifeCycle(SELF_ID)()))
+
+
+def bench_heartbeat(benchmark, singletons):
+    benchmark(lambda: run(event.HeartBeat(SELF_ID, 30)()))
+
+
+@pytest.mark.parametrize("case", ["passed", "filtered", "duplicate"])
+def bench_event_mapping(benchmark, config, singletons, case):
+    """ 被event_filter忽略或重复推送的消息只读取消息头 """
+    profile = MyProfile(uuid=SELF_ID, username="bench", bio="", lastUpdate="0", groups={GROUP}, friends={FRIEND})
+    if case == "filtered":
+        config = config.model_copy(update={"event_filter": EventFilter(deny={GROUP})})
+    message = chat(0, "hello world").model_dump()
+    counter = itertools.count(1)
+
+    def setup():
+        # 除duplicate外每次使用新的时间戳，避免被当作重复消息
+        if case == "duplicate":
+            return (message,), {}
+        return ({**message, "time": str(int(message["time"]) + next(counter))},), {}
+
+    benchmark.pedantic(lambda m: run(event.event_mapping(m, "0", config, profile)), setup=setup, rounds=2000)
@@ -0,0 +1,40 @@
+import base64
+from io import BytesIO
+
+import pytest
+
+from transcode import Transcoder
+from conftest import image_data_url
+
+SIZES = (64, 256, 1024)
+MAX_SIZE = 2048 << 10
+
+
+@pytest.mark.parametrize("size", SIZES)
+def bench_transcode(benchmark, size):
+    image = image_data_url(size)
+    benchmark.pedantic(Transcoder(MAX_SIZE).transcode_blocking, args=(image,), rounds=10 if size >= 1024 else 50)
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["search", "cached"])
+def bench_transcode_over_budget(benchmark, cached):
+    """ 随机像素的图片需要降低质量并缩小尺寸，重试时直接使用记录的参数 """
+    image = image_data_url(1024)
+    transcoder = Transcoder(256 << 10)
+    if cached:
+        transcoder.transcode_blocking(image)
+        benchmark.pedantic(transcoder.transcode_blocking, args=(image,), rounds=5)
+    else:
+        benchmark.pedantic(lambda: Transcoder(256 << 10).transcode_blocking(image), rounds=3)
+    assert len(base64.b64decode(transcoder.transcode_blocking(image).split(",")[1])) <= 256 << 10
+
+
+def bench_transcode_animated(benchmark):
+    from PIL import Image
+
+    frames = [Image.effect_noise((128, 128), 64 + i * 8).convert("P") for i in range(8)]
+    buffer = BytesIO()
+    frames[0].save(buffer, format="GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+    image = "data:image/gif;base64," + base64.b64encode(buffer.getvalue()).decode()
+    ret = benchmark.pedantic(Transcoder(MAX_SIZE).transcode_blocking, args=(image,), rounds=10)
+    assert Image.open(BytesIO(base64.b64decode(ret.split(",")[1]))).n_frames == len(frames)
@@ -0,0 +1,30 @@
+import pytest
+
+from api import GroupMemberInfo, GroupMemberInfoBatch, GroupMemberList
+from members import MemberIndex, MEMBER, ADMIN, OWNER
+from conftest import run, GROUP
+
+MEMBERS = 2000  # Mk.IX群的人数上限
+BATCH = 50      # 权限中间件一次查询的成员数
+
+
+@pytest.fixture
+def members(singletons):
+    roles = {str(i): MEMBER for i in range(MEMBERS)}
+    roles.update({"0": OWNER, "1": ADMIN, "2": ADMIN})
+    MemberIndex.get_instance().load(GROUP, roles)
+
+
+def bench_member_info(benchmark, config, members):
+    api = GroupMemberInfo(config)
+    benchmark(lambda: run(api(group_id=GROUP, user_id=str(MEMBERS - 1))))
+
+
+def bench_member_info_batch(benchmark, config, members):
+    api, user_ids = GroupMemberInfoBatch(config), [str(i) for i in range(0, MEMBERS, MEMBERS // BATCH)]
+    benchmark(lambda: run(api(group_id=GROUP, user_ids=user_ids)))
+
+
+def bench_member_list(benchmark, config, members):
+    api = GroupMemberList(config)
+    benchmark(lambda: run(api(group_id=GROUP)))
@@ -0,0 +1,26 @@
+import itertools
+
+from conftest import chat
+
+
+def bench_receive_chat(benchmark, singletons, config):
+    """ 记忆已满时每次写入都会淘汰最早的一条 """
+    memo, counter = singletons, itertools.count()
+    for _ in range(config.max_memo_size):
+        memo.receive_chat(chat(next(counter)), "group")
+    messages = [chat(next(counter)) for _ in range(200_000)]
+    iterator = iter(messages)
+    benchmark(lambda: memo.receive_chat(next(iterator), "group"))
+
+
+def bench_get_storage(benchmark, singletons, config):
+    memo, counter = singletons, itertools.count(10_000_000)
+
+    def setup():
+        message = chat(next(counter))
+        memo.receive_chat(message, "group")
+        return (message.time,), {}
+
+    for _ in range(config.max_memo_size):
+        memo.receive_chat(chat(next(counter)), "group")
+    benchmark.pedantic(memo.get_storage, setup=setup, rounds=5000)
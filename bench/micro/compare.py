@@ -0,0 +1,62 @@
+""" 将pytest-benchmark的结果与baseline.json对比
+
+cd bench/micro
+python -m pytest --benchmark-json=result.json
+python compare.py result.json [--tolerance 0.25]
+python compare.py result.json --update     # 更新baseline.json
+"""
+import os
+import sys
+import json
+import argparse
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def load_result(path: str) -> tuple[dict, dict[str, float]]:
+    with open(path, "r", encoding="utf-8") as F:
+        data = json.load(F)
+    machine = {k: data["machine_info"].get(k) for k in ("node", "processor", "machine", "python_version")}
+    return machine, {i["name"]: i["stats"]["median"] for i in data["benchmarks"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("result", help="pytest --benchmark-json的输出")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="中位数变慢超过该比例视为退化")
+    parser.add_argument("--update", action="store_true")
+    args = parser.parse_args()
+
+    machine, current = load_result(args.result)
+    if args.update:
+        with open(BASELINE, "w", encoding="utf-8") as F:
+            json.dump({"machine": machine, "median_seconds": dict(sorted(current.items()))}, F, indent=2)
+            F.write("\n")
+        print(f"Updated {BASELINE}")
+        return
+
+    with open(BASELINE, "r", encoding="utf-8") as F:
+        baseline = json.load(F)
+    if baseline["machine"] != machine:
+        print(f"NOTE: baseline was recorded on {baseline['machine']}, numbers may not be comparable")
+
+    regressions = 0
+    print(f"{'name':44} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name in sorted(set(current) | set(baseline["median_seconds"])):
+        old, new = baseline["median_seconds"].get(name), current.get(name)
+        if old is None or new is None:
+            old, new = (f"{i * 1e6:.1f}us" if i is not None else "-" for i in (old, new))
+            print(f"{name:44} {old:>12} {new:>12}")
+            continue
+        change = (new - old) / old
+        flag = ""
+        if change > args.tolerance:
+            flag, regressions = "  REGRESSION", regressions + 1
+        elif change < -args.tolerance:
+            flag = "  faster"
+        print(f"{name:44} {old * 1e6:>10.1f}us {new * 1e6:>10.1f}us {change:>+8.1%}{flag}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import base64
+import asyncio
+import contextvars
+from io import BytesIO
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+from api import FetchAPI    # noqa: E402
+from model import Config, MkIXGetMessage, MkIXSystemMessage    # noqa: E402
+from utils import MkIXMessageMemo, RequestMemo    # noqa: E402
+from members import MemberIndex    # noqa: E402
+
+GROUP = "100"
+FRIEND = "200"
+KEY = "abcdefghijklmnopqrstuvwxyz012345"
+
+
+def run(coro):
+    """ 不经过事件循环直接驱动不会挂起的协程，避免测到事件循环本身的开销 """
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("Coroutine suspended")
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def config():
+    return Config.model_validate({
+        "account": "1234567890",
+        "password": "bench",
+        "server_url": "http://127.0.0.1:8000",
+        "OneBot_url": "ws://127.0.0.1:8080",
+        "max_memo_size": 1024,
+        "ssl_check": True,
+        "webp": True,
+        "encrypt": {GROUP: KEY},
+        "ws_check": lambda: {"online": True, "good": True},
+    })
+
+
+@pytest.fixture(scope="session")
+def singletons(loop, config):
+    """ MkIXMessageMemo创建时需要运行中的事件循环，实例记录在Task的上下文中，再复制到当前上下文 """
+    async def create():
+        for i in (FetchAPI, RequestMemo, MkIXMessageMemo, MemberIndex):
+            i._instance.set(None)
+        FetchAPI(config)
+        RequestMemo()
+        MemberIndex()
+        MkIXMessageMemo(config)
+        return contextvars.copy_context()
+
+    for var, value in loop.run_until_complete(create()).items():
+        var.set(value)
+    return MkIXMessageMemo.get_instance()
+
+
+def chat(time: int, content: str = "hello", group: str = GROUP, type: str = "text", meta: dict = None) -> MkIXGetMessage:
+    return MkIXGetMessage.model_validate({
+        "time": str(1700000000000 + time),
+        "type": type,
+        "group": group,
+        "isSystemMessage": False,
+        "senderID": "300",
+        "payload": {"content": content, "name": "a.txt", "size": 3, "meta": meta or {}},
+    })
+
+
+def system(type: str, **kwargs) -> MkIXSystemMessage:
+    return MkIXSystemMessage.model_validate({
+        "time": "1700000000000",
+        "type": type,
+        "senderID": "300",
+        "target": GROUP,
+        "payload": json.dumps({"echo": 0, "time": "1700000000000"}),
+        **kwargs,
+    })
+
+
+def image_data_url(size: int) -> str:
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
@@ -0,0 +1,139 @@
+""" 回放capture_path记录的流量：Mk.IX帧由Mk.IX替身推送，OneBot Action由OneBot替身发出
+
+python bench/replay.py capture.jsonl.gz [--speed 1] [--friends UUID ...] [--set trace_path=/tmp/trace.json]
+
+--speed 2 为两倍速，--speed 0 为不等待、尽快发送。消息的时间戳会被替换为当前时间，echo帧由替身重新生成
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from fake_mkix import FakeMkIX
+from fake_onebot import FakeOneBot
+from run import ROOT, bridge, percentile, rss
+
+sys.path.insert(0, ROOT)
+
+import capture  # noqa: E402
+
+DRAIN_IDLE = 1      # 回放结束后，OneBot替身该时长内未收到新事件即停止，单位: s
+
+
+def load(path: str, sources: list[str]) -> list[tuple[float, str, dict]]:
+    """ 返回 [(相对时间s, 连接名, 帧)] """
+    frames = []
+    for i in capture.read(path):
+        if i["src"] not in sources:
+            continue
+        try:
+            frame = json.loads(i["raw"])
+        except ValueError:
+            continue
+        if i["src"] == "MkIXConnect" and frame.get("isSystemMessage") and frame.get("type") == "echo":
+            continue
+        frames.append((i["t"], i["src"], frame))
+    if not frames:
+        return []
+    start = frames[0][0]
+    return [(t - start, src, frame) for t, src, frame in frames]
+
+
+def conversations(frames: list[tuple[float, str, dict]]) -> set[str]:
+    return {
+        frame["group"] for _, src, frame in frames
+        if src == "MkIXConnect" and not frame.get("isSystemMessage") and frame.get("group")
+    }
+
+
+async def replay(args) -> dict:
+    frames = load(args.capture, args.sources)
+    if not frames:
+        raise ValueError(f"No frames in {args.capture}")
+    friends = set(args.friends)
+    mkix = FakeMkIX(latency=args.latency,
+                    groups=tuple(sorted(conversations(frames) - friends)) or ("100",),
+                    friends=tuple(sorted(friends)))
+    onebot = FakeOneBot()
+
+    async with bridge(args, mkix, onebot) as (proc, _):
+        latencies, failed, tasks, behind = [], 0, [], 0.0
+
+        async def call(frame: dict):
+            nonlocal failed
+            try:
+                latency, res = await onebot.call(frame["action"], frame.get("params", {}))
+            except Exception:
+                failed += 1
+                return
+            latencies.append(latency)
+            failed += res.get("status") != "ok"
+
+        base = onebot.message_count()
+        start = time.perf_counter()
+        for offset, src, frame in frames:
+            if args.speed:
+                delay = offset / args.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    behind = max(behind, -delay)
+            if src == "MkIXConnect":
+                if not frame.get("isSystemMessage"):
+                    frame = {**frame, "time": mkix.timestamp()}
+                await mkix.send(frame)
+            else:
+                tasks.append(asyncio.create_task(call(frame)))
+        sent = time.perf_counter() - start
+        await asyncio.gather(*tasks)
+
+        # 等待Mk.XI处理完剩余的帧
+        count = -1
+        while count != onebot.message_count():
+            count = onebot.message_count()
+            await asyncio.sleep(DRAIN_IDLE)
+
+        return {
+            "frames": len(frames),
+            "capture_s": round(frames[-1][0], 3),
+            "replay_s": round(sent, 3),
+            "max_behind_s": round(behind, 3),
+            "messages": count - base,
+            "actions": len(tasks),
+            "failed": failed,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0.0,
+            **rss(proc.pid),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture", help="capture_path记录的文件")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放倍速，0为尽快发送")
+    parser.add_argument("--sources", nargs="+", default=["MkIXConnect", "OneBotConnect"],
+                        choices=["MkIXConnect", "OneBotConnect"], help="只回放这些连接收到的帧")
+    parser.add_argument("--friends", nargs="*", default=[], help="私聊的会话id，其余会话视为群聊")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mk.IX替身的响应延迟，单位: s")
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="覆盖Mk.XI的配置项")
+    parser.add_argument("--json", help="将结果写入文件")
+    parser.add_argument("bridge_args", nargs="*", help="传给main.py的参数")
+    args = parser.parse_args()
+    args.capture = os.path.abspath(args.capture)
+
+    result = asyncio.run(replay(args))
+    print(f"replayed {result['frames']} frames ({result['capture_s']}s captured) in {result['replay_s']}s, "
+          f"max behind schedule {result['max_behind_s']}s")
+    print(f"messages {result['messages']}  actions {result['actions']}  failed {result['failed']}  "
+          f"p50 {result['p50_ms']}ms  p99 {result['p99_ms']}ms  rss {result['rss_kb']}KB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as F:
+            json.dump(result, F, indent=2)
+
+
+if __name__ == '__main__':
+    main()
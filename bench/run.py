@@ -0,0 +1,251 @@
+""" 端到端性能测试：在本地启动Mk.IX与OneBot的替身，以子进程运行Mk.XI
+
+pip install -r bench/requirements.txt
+python bench/run.py [--count 200] [--concurrency 8] [--latency 0] [--json result.json] [--compare baseline.json]
+python bench/run.py --compare asyncio.json --set uvloop=true    # 对比uvloop
+
+输出每种负载的吞吐、Action延迟p50/p99以及Mk.XI进程的RSS
+"""
+import os
+import io
+import sys
+import json
+import time
+import socket
+import base64
+import asyncio
+import argparse
+import contextlib
+import tempfile
+import statistics
+from typing import Optional
+
+import yaml
+
+from fake_mkix import FakeMkIX, ACCOUNT
+from fake_onebot import FakeOneBot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = "127.0.0.1"
+GROUP = "100"
+STARTUP_TIMEOUT = 30
+WORKLOADS = ("events", "text", "image", "file", "forward", "mixed")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def make_image(size: int) -> str:
+    """ 随机像素的PNG，难以压缩，接近截图的最坏情况 """
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return "base64://" + base64.b64encode(buffer.getvalue()).decode()
+
+
+def make_actions(args) -> dict[str, tuple[str, dict]]:
+    image = make_image(args.image_size)
+    small_image = make_image(64)
+    record = "base64://" + base64.b64encode(os.urandom(args.file_size)).decode()
+    return {
+        "text": ("send_group_msg", {"group_id": GROUP, "message": "hello [CQ:face,id=14] world"}),
+        "image": ("send_group_msg", {"group_id": GROUP, "message": [{"type": "image", "data": {"file": image}}]}),
+        "file": ("send_group_msg", {"group_id": GROUP, "message": [{"type": "record", "data": {"file": record}}]}),
+        "forward": ("send_group_forward_msg", {"group_id": GROUP, "messages": [{
+            "type": "node",
+            "data": {"name": "bench", "uin": ACCOUNT, "content": [
+                {"type": "text", "data": {"text": f"line {i}"}},
+                {"type": "image", "data": {"file": small_image}},
+            ]},
+        } for i in range(3)]}),
+    }
+
+
+def rss(pid: int) -> dict[str, Optional[int]]:
+    """ 单位: KB，仅Linux """
+    ret = {"rss_kb": None, "peak_rss_kb": None}
+    try:
+        with open(f"/proc/{pid}/status", "r") as F:
+            for line in F:
+                if line.startswith("VmRSS:"):
+                    ret["rss_kb"] = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    ret["peak_rss_kb"] = int(line.split()[1])
+    except OSError:
+        pass
+    return ret
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def run_events(mkix: FakeMkIX, onebot: FakeOneBot, count: int) -> dict:
+    base = onebot.message_count()
+    start = time.perf_counter()
+    await mkix.push(count)
+    await onebot.wait_messages(base + count, timeout=120)
+    elapsed = time.perf_counter() - start
+    return {"count": count, "seconds": round(elapsed, 3), "events_per_sec": round(count / elapsed, 1)}
+
+
+async def run_actions(onebot: FakeOneBot, action: str, params: dict, count: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failed = [], 0
+
+    async def call():
+        nonlocal failed
+        async with semaphore:
+            latency, res = await onebot.call(action, params)
+        latencies.append(latency)
+        failed += res["status"] != "ok"
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call() for _ in range(count)])
+    elapsed = time.perf_counter() - start
+    return {
+        "count": count,
+        "failed": failed,
+        "actions_per_sec": round(count / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2),
+    }
+
+
+@contextlib.asynccontextmanager
+async def bridge(args, mkix: FakeMkIX, onebot: FakeOneBot):
+    """ 启动替身与Mk.XI子进程，两端连接建立后返回 (进程, 启动耗时s) """
+    workdir = tempfile.mkdtemp(prefix="mkxi-bench-")
+    mkix_port, onebot_port = free_port(), free_port()
+    with open(os.path.join(workdir, "config.yaml"), "w", encoding="utf-8") as F:
+        yaml.safe_dump({
+            "account": ACCOUNT,
+            "password": "bench",
+            "server_url": f"http://{HOST}:{mkix_port}",
+            "OneBot_url": f"ws://{HOST}:{onebot_port}",
+            "max_memo_size": 1024,
+            "ssl_check": True,
+            "webp": True,
+            "encrypt": {},
+            **{k: yaml.safe_load(v) for k, v in (i.split("=", 1) for i in args.set)},
+        }, F)
+
+    await mkix.start(HOST, mkix_port)
+    await onebot.start(HOST, onebot_port)
+
+    log_path = os.path.join(workdir, "bridge.log")
+    start = time.perf_counter()
+    with open(log_path, "wb") as log:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "main.py"), *args.bridge_args,
+            cwd=workdir, stdout=log, stderr=log,
+        )
+    try:
+        await asyncio.wait_for(asyncio.gather(onebot.connected.wait(), mkix.connected.wait()), STARTUP_TIMEOUT)
+        yield proc, time.perf_counter() - start
+    except Exception:
+        print(f"bridge log: {log_path}", file=sys.stderr)
+        raise
+    finally:
+        if proc.returncode is None:
+            proc.terminate()
+            await proc.wait()
+        await onebot.stop()
+        await mkix.stop()
+
+
+async def run_mixed(onebot: FakeOneBot, actions: dict, count: int, concurrency: int) -> dict:
+    """ 持续上传文件的同时发送文本，统计文本的延迟 """
+    background = asyncio.create_task(run_actions(onebot, *actions["file"], count, concurrency))
+    result = await run_actions(onebot, *actions["text"], count, concurrency)
+    result["background_actions_per_sec"] = (await background)["actions_per_sec"]
+    return result
+
+
+async def run(args) -> dict:
+    mkix = FakeMkIX(latency=args.latency, groups=(GROUP,))
+    onebot = FakeOneBot()
+    async with bridge(args, mkix, onebot) as (proc, startup):
+        _, status = await onebot.call("get_status", {})
+        result = {"startup_s": round(startup, 3), "loop": ",".join(status["data"]["stat"]["event_loop"]), **rss(proc.pid)}
+        actions = make_actions(args)
+        for name in args.workloads:
+            if name == "events":
+                result[name] = await run_events(mkix, onebot, args.count)
+            elif name == "mixed":
+                result[name] = await run_mixed(onebot, actions, args.count, args.concurrency)
+            else:
+                action, params = actions[name]
+                result[name] = await run_actions(onebot, action, params, args.count, args.concurrency)
+            result[name].update(rss(proc.pid))
+        return result
+
+
+def report(result: dict) -> None:
+    print(f"loop: {result['loop']}  startup: {result['startup_s']}s  rss: {result['rss_kb']}KB")
+    for name in WORKLOADS:
+        if name not in result:
+            continue
+        i = result[name]
+        if name == "events":
+            print(f"{name:8} {i['events_per_sec']:>10} events/s                          rss {i['rss_kb']}KB")
+        else:
+            print(f"{name:8} {i['actions_per_sec']:>10} actions/s  p50 {i['p50_ms']:>8}ms  p99 {i['p99_ms']:>8}ms"
+                  f"  failed {i['failed']}  rss {i['rss_kb']}KB")
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> bool:
+    """ 吞吐下降或p99上升超过tolerance视为退化 """
+    ok = True
+    if result.get("loop") != baseline.get("loop"):
+        print(f"loop     {baseline.get('loop')} -> {result.get('loop')}")
+    for name in WORKLOADS:
+        if name not in result or name not in baseline:
+            continue
+        checks = [("events_per_sec", -1)] if name == "events" else [("actions_per_sec", -1), ("p99_ms", 1)]
+        for key, direction in checks:
+            new, old = result[name][key], baseline[name][key]
+            if not old:
+                continue
+            change = (new - old) / old
+            regressed = change * direction > tolerance
+            ok &= not regressed
+            print(f"{name:8} {key:16} {old:>10} -> {new:>10} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200, help="每种负载的消息/Action数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时进行的Action数")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mk.IX替身的响应延迟，单位: s")
+    parser.add_argument("--image-size", type=int, default=512, help="图片边长，单位: px")
+    parser.add_argument("--file-size", type=int, default=256 << 10, help="文件大小，单位: B")
+    parser.add_argument("--workloads", nargs="+", default=list(WORKLOADS), choices=WORKLOADS)
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="覆盖Mk.XI的配置项")
+    parser.add_argument("--json", help="将结果写入文件")
+    parser.add_argument("--compare", help="与之前的结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("bridge_args", nargs="*", help="传给main.py的参数")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as F:
+            json.dump(result, F, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as F:
+            ok = compare(result, json.load(F), args.tolerance)
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import gzip
+import json
+import time
+import queue
+import threading
+from typing import Iterator, Optional
+
+import metrics
+
+CAPTURE_FLUSH_SIZE = 100    # 每记录该数量的帧后刷新到文件
+CAPTURE_FLUSH_INTERVAL = 1  # 距上次刷新超过该时长也刷新，单位: s
+CAPTURE_QUEUE_SIZE = 1024   # 等待写入的帧数上限，写入跟不上时丢弃新的帧
+
+_FLUSH = object()
+_queue: Optional[queue.Queue] = None
+_thread: Optional[threading.Thread] = None
+
+
+def enabled() -> bool:
+    return _queue is not None
+
+
+def configure(path: Optional[str]) -> None:
+    """ 设置path后记录收到的Mk.IX帧与OneBot Action，由写入线程以gzip追加写入，每行一帧 """
+    global _queue, _thread
+    close()
+    if path:
+        _queue = queue.Queue(CAPTURE_QUEUE_SIZE)
+        _thread = threading.Thread(target=_write, args=(gzip.open(path, "ab"), _queue), name="capture", daemon=True)
+        _thread.start()
+
+
+def record(source: str, raw) -> None:
+    """ source: 连接名，raw: 原始帧；事件循环上只入队，序列化与压缩在写入线程 """
+    if _queue is None:
+        return
+    try:
+        _queue.put_nowait((time.time(), source, raw))
+    except queue.Full:
+        metrics.CAPTURE_DROPPED.inc()
+
+
+def flush() -> None:
+    """ 通知写入线程刷新 """
+    if _queue is not None:
+        _queue.put(_FLUSH)
+
+
+def close() -> None:
+    """ 写完已入队的帧后关闭文件 """
+    global _queue, _thread
+    if _queue is not None:
+        _queue.put(None)
+        _thread.join()
+        _queue, _thread = None, None
+
+
+def _write(file: gzip.GzipFile, frames: queue.Queue) -> None:
+    pending, flushed_at = 0, time.time()
+    while True:
+        try:
+            item = frames.get(timeout=CAPTURE_FLUSH_INTERVAL)
+        except queue.Empty:
+            item = _FLUSH
+        if item is None:
+            break
+        if item is not _FLUSH:
+            now, source, raw = item
+            if isinstance(raw, bytes):
+                raw = raw.decode("utf-8", "replace")
+            file.write(json.dumps({"t": now, "src": source, "raw": raw}, ensure_ascii=False).encode() + b"\n")
+            pending += 1
+        # Z_SYNC_FLUSH，进程异常退出时已刷新的部分仍可读取
+        if pending and (item is _FLUSH or pending >= CAPTURE_FLUSH_SIZE or time.time() - flushed_at >= CAPTURE_FLUSH_INTERVAL):
+            file.flush()
+            pending, flushed_at = 0, time.time()
+    file.close()
+
+
+def read(path: str) -> Iterator[dict]:
+    """ 依次返回 {"t": 时间戳, "src": 连接名, "raw": 原始帧}，忽略末尾未写完的部分 """
+    with gzip.open(path, "rb") as F:
+        try:
+            for line in F:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+        except (EOFError, gzip.BadGzipFile):
+            return
@@ -0,0 +1,47 @@
+import os
+import base64
+import asyncio
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+
+CRYPTO_OFFLOAD_SIZE = 64 << 10  # 超过该大小的数据在线程池中加解密，pycryptodome计算时释放GIL，单位: B
+KEY_SIZES = (16, 24, 32)
+
+# 线程数不超过CPU数，否则工作线程之间争抢GIL，事件循环反而等待更久
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="crypto")
+
+
+class Cipher:
+    """ 加载配置时准备各会话的密钥，与前端一致使用AES-CBC """
+
+    def __init__(self, keys: dict[str, str]):
+        self._keys = {k: v.encode("utf-8") for k, v in keys.items()}
+        if self._keys:
+            # 配置了密钥时才导入，之后每次加解密不再查找模块
+            from Crypto.Cipher import AES
+            from Crypto.Random import get_random_bytes
+            from Crypto.Util.Padding import pad, unpad
+            self._aes, self._random, self._pad, self._unpad = AES, get_random_bytes, pad, unpad
+
+    def __contains__(self, group: str) -> bool:
+        return group in self._keys
+
+    def encrypt_blocking(self, group: str, content: str) -> tuple[str, str]:
+        """ 返回 (base64密文, iv的hex) """
+        iv = self._random(16)
+        encrypted = self._aes.new(self._keys[group], self._aes.MODE_CBC, iv).encrypt(self._pad(content.encode("utf-8"), 16))
+        return base64.b64encode(encrypted).decode("utf-8"), iv.hex()
+
+    def decrypt_blocking(self, group: str, content: str, iv: str) -> str:
+        cipher = self._aes.new(self._keys[group], self._aes.MODE_CBC, binascii.unhexlify(iv))
+        return self._unpad(cipher.decrypt(base64.b64decode(content)), self._aes.block_size).decode("utf-8")
+
+    async def encrypt(self, group: str, content: str) -> tuple[str, str]:
+        if len(content) < CRYPTO_OFFLOAD_SIZE:
+            return self.encrypt_blocking(group, content)
+        return await asyncio.get_running_loop().run_in_executor(_executor, self.encrypt_blocking, group, content)
+
+    async def decrypt(self, group: str, content: str, iv: str) -> str:
+        if len(content) < CRYPTO_OFFLOAD_SIZE:
+            return self.decrypt_blocking(group, content, iv)
+        return await asyncio.get_running_loop().run_in_executor(_executor, self.decrypt_blocking, group, content, iv)
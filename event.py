@@ -1,14 +1,13 @@
-import base64
-import binascii
 from abc import ABC, abstractmethod
 from typing import Literal, Optional, Union, Awaitable
 
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import unpad
-
+import metrics
+import tracing
+from log import summarize
 from api import FetchAPI, Status, GetMyProfile
 from model import Config, MyProfile, Message, MkIXGetMessage, MkIXSystemMessage
 from utils import MkIXMessageMemo, CQCode, RequestMemo, Tools
+from members import MemberIndex, MEMBER, ADMIN
 
 
 class Event(ABC):
@@ -31,22 +30,17 @@ class MessageEvent(Event):
     _post_type = "message"
     _message: MkIXGetMessage
 
-    def _decrypt(self) -> None:
+    async def _decrypt(self) -> None:
         # 未加密
         if not self._message.payload.meta.get("encrypt", False):
             return
         # 加密但未设置密钥
-        if self._message.group not in self._config.encrypt:
+        if self._message.group not in self._config.cipher:
             raise RuntimeError
 
-        key = self._config.encrypt[self._message.group].encode("utf-8")
-        iv = binascii.unhexlify(self._message.payload.meta.get("iv", ""))
         try:
-            data = base64.b64decode(self._message.payload.content)
-            cipher = AES.new(key, AES.MODE_CBC, iv)
-            decrypted = unpad(cipher.decrypt(data), AES.block_size)
-            self._message.payload.content = decrypted.decode('utf-8')
-            return
+            self._message.payload.content = await self._config.cipher.decrypt(
+                self._message.group, self._message.payload.content, self._message.payload.meta.get("iv", ""))
         except Exception:
             raise RuntimeError
 
@@ -55,7 +49,7 @@ class PrivateMessageEvent(MessageEvent):
 
     async def __call__(self):
         try:
-            self._decrypt()
+            await self._decrypt()
         except Exception:
             return None
         return {
@@ -80,7 +74,7 @@ class GroupMessageEvent(MessageEvent):
 
     async def __call__(self):
         try:
-            self._decrypt()
+            await self._decrypt()
         except Exception:
             return None
         return {
@@ -300,24 +294,41 @@ class LifeCycle(MetaEvent):
 
 class HeartBeat(MetaEvent):
 
+    def __init__(self, self_id: str, interval: int):
+        super().__init__(self_id)
+        self._interval = interval
+
     async def __call__(self):
-        status = await FetchAPI.get_instance().call(Status)
+        status = await FetchAPI.get_instance().call(Status, stat=False)
         return {
             "time": int(Tools.timestamp()),
             "self_id": int(self._self_id),
             "post_type": self._post_type,
             "meta_event_type": "heartbeat",
             "status": status,
-            "interval": 30000,
+            "interval": self._interval * 1000,
         }
 
 
+@tracing.traced("event_mapping")
 async def event_mapping(message: dict,
                         launch_time: str,
                         config: Config,
                         profile: MyProfile) -> Awaitable[Optional[dict]]:
-    Tools.logger().info(f'Receive MkIX message: {message}')
+    # 在校验、解密与序列化之前，仅根据消息头丢弃被过滤的聊天消息
+    header = None if message.get("isSystemMessage") else _header_type(message, profile)
+    if header and config.event_filter.blocks(*header, message.get("group"), message.get("senderID")):
+        metrics.EVENTS_FILTERED.inc("header")
+        return None
+
     memo = MkIXMessageMemo.get_instance()
+    members = MemberIndex.get_instance()
+    # 重连后服务器可能重复推送最近的消息
+    if not message.get("isSystemMessage") and memo.is_duplicate(message):
+        metrics.DUPLICATES.inc()
+        return None
+
+    Tools.logger().info('Receive MkIX message: %s', summarize(message))
 
     def handle_system_message(model: MkIXSystemMessage):
         if model.type == "echo":
@@ -329,6 +340,7 @@ async def event_mapping(message: dict,
                 profile.friends.add(model.meta["var"]["id"])
                 return FriendAdd
             if op in ("group_admin_set", "group_admin_unset"):
+                members.set_role(model.meta["var"]["id"], profile.uuid, ADMIN if op == "group_admin_set" else MEMBER)
                 return GroupAdmin
             return None
         req_memo = RequestMemo.get_instance()
@@ -346,10 +358,15 @@ async def event_mapping(message: dict,
             if op in ("group_joined"):
                 if model.payload.meta["var"]["id"] == profile.uuid:
                     profile.groups.add(model.group)
+                members.join(model.group, model.payload.meta["var"]["id"])
                 return GroupIncrease
             if op in ("group_ban", "group_lift_ban"):
                 return GroupBan
             if op in ("group_kick", "group_leave"):
+                if model.payload.meta["var"]["id"] == profile.uuid:
+                    members.drop(model.group)
+                else:
+                    members.leave(model.group, model.payload.meta["var"]["id"])
                 return GroupDecrease
             return None
         if model.type == "file":
@@ -374,8 +391,11 @@ async def event_mapping(message: dict,
         event = handle_system_message(model)
     else:
         model = MkIXGetMessage.model_validate(message)
-        if model.group not in (profile.groups | profile.friends):
+        if model.group in profile.groups or model.group in profile.friends:
+            metrics.CACHE.inc("profile", "hit")
+        else:
             # 加入过新群/新好友，刷新profile
+            metrics.CACHE.inc("profile", "miss")
             res = await FetchAPI.get_instance().call(GetMyProfile)
             profile.groups = {i["group"] for i in res["groups"]}
             profile.friends = {i["uuid"] for i in res["friends"]}
@@ -388,4 +408,31 @@ async def event_mapping(message: dict,
         if model.time < launch_time or model.senderID == profile.uuid:
             return None
 
-    return (await event(model, config, profile.uuid)()) if event else None
+    ret = (await event(model, config, profile.uuid)()) if event else None
+    if ret and config.event_filter.blocks(
+            ret["post_type"],
+            ret.get("notice_type") or ret.get("request_type") or ret.get("message_type"),
+            ret.get("group_id", ret.get("user_id")),
+            ret.get("user_id")):
+        metrics.EVENTS_FILTERED.inc("event")
+        return None
+    return ret
+
+
+def _header_type(message: dict, profile: MyProfile) -> Optional[tuple[str, str]]:
+    """ 只读取消息头推断 (post_type, 细分类型)，无法确定时返回None，交由构造事件后过滤 """
+    group = message.get("group")
+    if group in profile.groups:
+        kind = "group"
+    elif group in profile.friends:
+        kind = "private"
+    else:
+        return None
+    t = message.get("type")
+    if t == "system":   # 可能修改profile
+        return None
+    if t == "file":
+        return "notice", "group_upload"
+    if t == "revoke":
+        return "notice", "group_recall" if kind == "group" else "friend_recall"
+    return "message", kind
@@ -0,0 +1,173 @@
+import json
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+from contextvars import ContextVar
+from typing import Any, Optional
+
+LOG_FIELD_LIMIT = 200   # 单个字段最多保留的字符数
+LOG_MESSAGE_LIMIT = 500
+LOG_MAX_DEPTH = 6
+REDACT_KEYS = {"password", "token", "access_token", "Authorization", "key"}
+
+logger: Optional[logging.Logger] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_console: Optional[logging.Handler] = None
+_sampler: Optional['SamplingFilter'] = None
+_account: ContextVar[Optional[str]] = ContextVar("account", default=None)
+
+
+def summarize(obj: Any, limit: int = LOG_FIELD_LIMIT, depth: int = 0) -> Any:
+    """ 按结构截断与脱敏，不拼接整个消息的字符串 """
+    if depth >= LOG_MAX_DEPTH:
+        return "..."
+    if hasattr(obj, "model_fields"):  # pydantic
+        obj = dict(obj)
+    if isinstance(obj, dict):
+        return {
+            k: "***" if k in REDACT_KEYS and v else summarize(v, limit, depth + 1)
+            for k, v in obj.items()
+        }
+    if isinstance(obj, (list, tuple, set)):
+        ret = [summarize(i, limit, depth + 1) for i in list(obj)[:limit]]
+        if len(obj) > limit:
+            ret.append(f"...(+{len(obj) - limit})")
+        return ret
+    if isinstance(obj, (str, bytes)) and len(obj) > limit:
+        return f"{obj[:limit]}...(+{len(obj) - limit})"
+    return obj
+
+
+class SamplingFilter(logging.Filter):
+    """ 每处INFO及以下的日志每秒最多通过rate条，0为不限制，超出的条数在下一秒汇报 """
+
+    def __init__(self, rate: int = 0):
+        super().__init__()
+        self.rate = rate
+        self._window = 0
+        self._counter: dict[tuple[str, int], int] = {}
+        self._dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rate or record.levelno > logging.INFO:
+            return True
+        window = int(time.monotonic())
+        if window != self._window:
+            self._window = window
+            self._counter.clear()
+            if self._dropped:
+                record.sampled = self._dropped
+                self._dropped = 0
+        # 按调用位置计数，f-string日志的每条内容都不同；key的数量不超过调用位置的数量
+        key = (record.pathname, record.lineno)
+        count = self._counter.get(key, 0) + 1
+        self._counter[key] = count
+        if count > self.rate:
+            self._dropped += 1
+            return False
+        return True
+
+
+class AccountFilter(logging.Filter):
+    """ 在记录日志的Task中读取账号，之后交给日志线程 """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.account = _account.get()
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """ 不在事件循环上格式化日志，交给QueueListener所在的线程 """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.exc_text = record.exc_text or (
+            logging.Formatter().formatException(record.exc_info) if record.exc_info else None
+        )
+        record.exc_info = None
+        return record
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        ret = {
+            "time": record.created,
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "account", None):
+            ret["account"] = record.account
+        if isinstance(record.args, dict):
+            ret["data"] = record.args
+        if getattr(record, "sampled", 0):
+            ret["sampled"] = record.sampled
+        if record.exc_text:
+            ret["exc"] = record.exc_text
+        return json.dumps(ret, ensure_ascii=False, default=str)
+
+
+def _rich_handler() -> logging.Handler:
+    from rich.logging import RichHandler
+
+    class RichHandlerCut(RichHandler):
+        def emit(self, record):
+            record = logging.makeLogRecord(record.__dict__)  # 其余handler仍需要原始的args
+            message = record.getMessage()
+            if len(message) > LOG_MESSAGE_LIMIT:
+                message = message[:LOG_MESSAGE_LIMIT] + "..."
+            if getattr(record, "sampled", 0):
+                message += f" ({record.sampled} sampled out)"
+            if getattr(record, "account", None):
+                message = f"[{record.account}] {message}"
+            record.msg, record.args = message, None
+            super().emit(record)
+
+    handler = RichHandlerCut()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+    return handler
+
+
+def get_logger() -> logging.Logger:
+    """ 首次使用时才导入rich并启动日志线程 """
+    global logger, _listener, _console, _sampler
+    if logger is not None:
+        return logger
+
+    _console = _rich_handler()
+    _sampler = SamplingFilter()
+    _listener = logging.handlers.QueueListener(queue.SimpleQueue(), _console, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    handler = LazyQueueHandler(_listener.queue)
+    handler.addFilter(_sampler)
+    handler.addFilter(AccountFilter())
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(handler)
+    logger = logging.getLogger("rich_logger")
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def bind_account(account: str) -> None:
+    """ 当前Task及之后创建的子Task记录的日志带上账号 """
+    _account.set(account)
+
+
+def configure(rate: int = 0, json_path: Optional[str] = None) -> None:
+    """ 设置采样频率及JSON lines输出 """
+    get_logger()
+    _sampler.rate = rate
+    handlers = [_console]
+    if json_path:
+        sink = logging.FileHandler(json_path, encoding="utf-8")
+        sink.setFormatter(JsonLinesFormatter())
+        handlers.append(sink)
+    for i in _listener.handlers:
+        if i not in handlers:
+            i.close()
+    _listener.handlers = tuple(handlers)
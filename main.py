@@ -1,7 +1,20 @@
+import signal
 import asyncio
+import argparse
 
 from mkxi import MkXI
 
 
 if __name__ == '__main__':
-    asyncio.run(MkXI().run())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", nargs="*", help="只运行这些账号")
+    parser.add_argument("--accounts-file", help="只运行该文件中的账号，每行一个，收到SIGHUP时重新读取，由supervisor.py分配")
+    parser.add_argument("--shard", type=int, help="worker编号，log_json、trace_path、capture_path加上该后缀")
+    parser.add_argument("--metrics-port", type=int, help="覆盖metrics_port")
+    parser.add_argument("--uvloop", action="store_true", help="使用uvloop，与配置uvloop: true相同")
+    args = parser.parse_args()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)    # 事件循环安装处理函数之前收到SIGHUP时不退出
+    mkxi = MkXI(args.accounts, args.shard, args.metrics_port, args.accounts_file)
+    mkxi.install_loop(args.uvloop)
+    asyncio.run(mkxi.run())
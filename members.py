@@ -0,0 +1,105 @@
+import time
+import asyncio
+from contextvars import ContextVar
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+import metrics
+
+MEMBER_INDEX_TTL = 10 * 60          # 其他成员的管理员变动没有事件通知，超过该时长后重新拉取，单位: s
+MEMBER_INDEX_MAX_GROUPS = 1024      # 最多索引的群数，超出后丢弃最久未使用的
+ROLES = ("member", "admin", "owner")
+MEMBER, ADMIN, OWNER = range(len(ROLES))
+
+# get_group_member_info的返回值中Mk.IX没有的字段
+MEMBER_INFO = {
+    "nick_name": "",
+    "card": "",
+    "sex": "",
+    "age": -1,
+    "area": "",
+    "join_time": -1,
+    "last_sent_time": -1,
+    "level": "",
+    "unfriendly": "",
+    "title": "",
+    "title_expire_time": -1,
+    "card_changeable": False,
+}
+
+
+def member_info(group_id: str, user_id: str, role: int) -> dict:
+    return {"group_id": group_id, "user_id": user_id, **MEMBER_INFO, "role": ROLES[role]}
+
+
+class MemberIndex:
+    """ 群 -> {成员: 角色}，首次查询时拉取，之后由成员变动事件增量更新
+    OneBot传入的id为int，Mk.IX事件中的为str，各入口统一转为str """
+    _instance: ContextVar[Optional['MemberIndex']] = ContextVar("MemberIndex", default=None)   # 每个账号一个
+
+    def __init__(self):
+        if MemberIndex._instance.get() is not None:
+            raise ValueError("Already instantiated")
+        self._groups: OrderedDict[str, tuple[float, dict[str, int]]] = OrderedDict()   # 群 -> (拉取时间, 成员)
+        self._loading: dict[str, asyncio.Future] = dict()
+        self._gauge = lambda: len(self._groups)
+        metrics.QUEUE_DEPTH.add_function("members", func=self._gauge)
+        MemberIndex._instance.set(self)
+
+    def close(self) -> None:
+        """ 取消进行中的拉取，注销指标回调 """
+        for future in list(self._loading.values()):
+            future.cancel()
+        metrics.QUEUE_DEPTH.remove_function("members", func=self._gauge)
+
+    @classmethod
+    def get_instance(cls) -> 'MemberIndex':
+        instance = cls._instance.get()
+        if instance is None:
+            raise ValueError("Not instantiated yet")
+        return instance
+
+    def get(self, group_id: str) -> Optional[dict[str, int]]:
+        """ 未索引或已过期时返回None """
+        group_id = str(group_id)
+        entry = self._groups.get(group_id)
+        if entry is None or time.monotonic() - entry[0] > MEMBER_INDEX_TTL:
+            return None
+        self._groups.move_to_end(group_id)
+        return entry[1]
+
+    async def roles(self, group_id: str, loader: Callable[[], Awaitable[dict[str, int]]]) -> dict[str, int]:
+        """ 未命中时调用loader拉取，并发的拉取合并为一次请求 """
+        group_id = str(group_id)
+        ret = self.get(group_id)
+        if ret is not None:
+            metrics.CACHE.inc("members", "hit")
+            return ret
+        metrics.CACHE.inc("members", "miss")
+        if group_id not in self._loading:
+            self._loading[group_id] = asyncio.ensure_future(loader())
+            self._loading[group_id].add_done_callback(lambda _: self._loading.pop(group_id, None))
+        return self.load(group_id, await asyncio.shield(self._loading[group_id]))
+
+    def load(self, group_id: str, roles: dict[str, int]) -> dict[str, int]:
+        group_id, roles = str(group_id), {str(k): v for k, v in roles.items()}
+        self._groups[group_id] = (time.monotonic(), roles)
+        self._groups.move_to_end(group_id)
+        if len(self._groups) > MEMBER_INDEX_MAX_GROUPS:
+            self._groups.popitem(last=False)
+        return roles
+
+    def join(self, group_id: str, user_id: str) -> None:
+        if str(group_id) in self._groups:
+            self._groups[str(group_id)][1].setdefault(str(user_id), MEMBER)
+
+    def leave(self, group_id: str, user_id: str) -> None:
+        if str(group_id) in self._groups:
+            self._groups[str(group_id)][1].pop(str(user_id), None)
+
+    def set_role(self, group_id: str, user_id: str, role: int) -> None:
+        if str(group_id) in self._groups:
+            self._groups[str(group_id)][1][str(user_id)] = role
+
+    def drop(self, group_id: str) -> None:
+        self._groups.pop(str(group_id), None)
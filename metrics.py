@@ -0,0 +1,301 @@
+import time
+import asyncio
+import functools
+from bisect import bisect_left
+from typing import Awaitable, Callable, Optional
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # 单位: s
+LOOP_LAG_INTERVAL = 1   # 单位: s
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    _type: str
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+
+    def _label_str(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def expose(self) -> list[str]:
+        raise NotImplementedError
+
+    def summary(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    _type = "counter"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, value: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def remove(self, *labels) -> None:
+        self._values.pop(labels, None)
+
+    def expose(self) -> list[str]:
+        return [f"{self.name}{self._label_str(k)} {v}" for k, v in self._values.items()]
+
+    def summary(self):
+        if not self.labels:
+            return self._values.get((), 0)
+        return {",".join(map(str, k)): v for k, v in self._values.items()}
+
+
+class Gauge(Metric):
+    """ 可以直接设置，也可以在导出时调用callback取值 """
+    _type = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self._values: dict[tuple, float] = {}
+        self._callbacks: dict[tuple, list[Callable[[], float]]] = {}
+
+    def set(self, *labels, value: float) -> None:
+        self._values[labels] = value
+
+    def set_function(self, *labels, func: Callable[[], float]) -> None:
+        self._callbacks[labels] = [func]
+
+    def add_function(self, *labels, func: Callable[[], float]) -> None:
+        """ 多个账号的同名队列，导出时求和 """
+        self._callbacks.setdefault(labels, []).append(func)
+
+    def remove_function(self, *labels, func: Callable[[], float]) -> None:
+        """ 账号停止时注销add_function登记的回调 """
+        funcs = self._callbacks.get(labels, [])
+        if func in funcs:
+            funcs.remove(func)
+        if not funcs:
+            self._callbacks.pop(labels, None)
+
+    def _collect(self) -> dict[tuple, float]:
+        ret = dict(self._values)
+        for k, funcs in self._callbacks.items():
+            try:
+                ret[k] = sum(func() for func in funcs)
+            except Exception:
+                pass
+        return ret
+
+    def expose(self) -> list[str]:
+        return [f"{self.name}{self._label_str(k)} {v}" for k, v in self._collect().items()]
+
+    def summary(self):
+        values = self._collect()
+        if not self.labels:
+            return values.get((), 0)
+        return {",".join(map(str, k)): v for k, v in values.items()}
+
+
+class Histogram(Metric):
+    _type = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self._buckets = buckets
+        self._counts: dict[tuple, list[int]] = {}   # 最后一格为+Inf
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, *labels, value: float) -> None:
+        if labels not in self._counts:
+            self._counts[labels] = [0] * (len(self._buckets) + 1)
+            self._sums[labels] = 0.0
+        self._counts[labels][bisect_left(self._buckets, value)] += 1
+        self._sums[labels] += value
+
+    def time(self, *labels) -> 'Timer':
+        return Timer(self, labels)
+
+    def quantile(self, labels: tuple, q: float) -> float:
+        """ 以所在桶的上界估计分位数 """
+        counts = self._counts.get(labels)
+        if not counts:
+            return 0.0
+        target, acc = q * sum(counts), 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            acc += count
+            if acc >= target:
+                return bound
+        return float("inf")
+
+    def expose(self) -> list[str]:
+        ret = []
+        for k, counts in self._counts.items():
+            acc = 0
+            for bound, count in zip(self._buckets + ("+Inf",), counts):
+                acc += count
+                le = f'le="{bound}"'
+                ret.append(f"{self.name}_bucket{self._label_str(k, le)} {acc}")
+            ret.append(f"{self.name}_sum{self._label_str(k)} {self._sums[k]}")
+            ret.append(f"{self.name}_count{self._label_str(k)} {acc}")
+        return ret
+
+    def summary(self):
+        ret = {}
+        for k, counts in self._counts.items():
+            count = sum(counts)
+            p50, p99 = self.quantile(k, 0.5), self.quantile(k, 0.99)
+            ret[",".join(map(str, k)) or "all"] = {
+                "count": count,
+                "avg": round(self._sums[k] / count, 6),
+                "p50": p50 if p50 != float("inf") else None,     # 超出最大的桶
+                "p99": p99 if p99 != float("inf") else None,
+            }
+        return ret
+
+
+class Timer:
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(*self._labels, value=time.perf_counter() - self._start)
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def _register(self, cls, name: str, doc: str, labels: tuple[str, ...] = (), **kwargs):
+        if name not in self._metrics:
+            self._metrics[name] = cls(name, doc, labels, **kwargs)
+        return self._metrics[name]
+
+    def counter(self, name: str, doc: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, doc, labels)
+
+    def gauge(self, name: str, doc: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge, name, doc, labels)
+
+    def histogram(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, doc, labels, buckets=buckets)
+
+    def expose(self) -> str:
+        """ Prometheus文本格式 """
+        lines = []
+        for i in self._metrics.values():
+            lines.append(f"# HELP {i.name} {i.doc}")
+            lines.append(f"# TYPE {i.name} {i._type}")
+            lines.extend(i.expose())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        return {name.removeprefix("mkxi_"): i.summary() for name, i in self._metrics.items()}
+
+
+REGISTRY = Registry()
+
+ACTIONS = REGISTRY.counter("mkxi_actions_total", "OneBot actions received", ("action", "status"))
+ACTION_LATENCY = REGISTRY.histogram("mkxi_action_seconds", "OneBot action handling latency", ("action",))
+EVENTS = REGISTRY.counter("mkxi_events_total", "Events sent to OneBot", ("post_type",))
+EVENTS_FILTERED = REGISTRY.counter("mkxi_events_filtered_total", "Events dropped by event_filter", ("stage",))
+DUPLICATES = REGISTRY.counter("mkxi_duplicates_total", "Redelivered Mk.IX messages dropped")
+EVENT_LATENCY = REGISTRY.histogram("mkxi_event_build_seconds", "Time to build an event from a Mk.IX message")
+ECHO_RTT = REGISTRY.histogram("mkxi_echo_rtt_seconds", "Mk.IX send to echo round trip", ("type",))
+HTTP_LATENCY = REGISTRY.histogram("mkxi_http_seconds", "Mk.IX HTTP API latency", ("api",))
+HTTP_ERRORS = REGISTRY.counter("mkxi_http_errors_total", "Mk.IX HTTP API errors", ("api",))
+SEND_WAIT = REGISTRY.histogram("mkxi_send_wait_seconds", "Time a batch waits in the send scheduler", ("lane",))
+QUEUE_DEPTH = REGISTRY.gauge("mkxi_queue_depth", "Items waiting in MkIXMessageMemo", ("queue",))
+RECONNECTS = REGISTRY.counter("mkxi_reconnects_total", "WebSocket reconnects", ("connection",))
+RATE_LIMITED = REGISTRY.counter("mkxi_rate_limited_total", "Rate limiter decisions", ("result",))
+CACHE = REGISTRY.counter("mkxi_cache_total", "Cache lookups", ("cache", "result"))
+LOOP_LAG = REGISTRY.histogram("mkxi_loop_lag_seconds", "Event loop scheduling lag")
+EVENT_LOOP = REGISTRY.gauge("mkxi_event_loop", "Event loop implementation in use", ("loop",))
+CAPTURE_DROPPED = REGISTRY.counter("mkxi_capture_dropped_total", "Frames dropped because the capture writer fell behind")
+CONFIG_RELOADS = REGISTRY.counter("mkxi_config_reloads_total", "config.yaml reloads", ("result",))
+# 账号在本进程运行期间存在该序列，supervisor.py迁移账号时据此等待原进程中的账号退出
+ACCOUNT_LOAD = REGISTRY.counter("mkxi_account_messages_total", "Mk.IX messages and OneBot actions per account", ("account",))
+
+
+def parse(text: str) -> dict[str, float]:
+    """ Prometheus文本格式 -> {序列: 值} """
+    ret = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            series, _, value = line.rpartition(" ")
+            ret[series] = float(value)
+    return ret
+
+
+def merge(texts: list[str]) -> str:
+    """ 合并多个进程导出的指标，同一序列的值相加 """
+    families: dict[str, tuple[list[str], dict[str, float]]] = {}    # 指标名 -> (注释, {序列: 值})
+    for text in texts:
+        comments, values = [], {}
+        for line in text.splitlines():
+            if line.startswith("# "):
+                comments, values = families.setdefault(line.split(" ")[2], ([], {}))
+                if line not in comments:
+                    comments.append(line)
+            elif line:
+                series, _, value = line.rpartition(" ")
+                values[series] = values.get(series, 0) + float(value)
+    lines = []
+    for comments, values in families.values():
+        lines.extend(comments)
+        lines.extend(f"{k} {v}" for k, v in values.items())
+    return "\n".join(lines) + "\n"
+
+
+async def _measure_loop_lag():
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(value=max(0.0, time.perf_counter() - start - LOOP_LAG_INTERVAL))
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, expose: Callable[[], Awaitable[str]]):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+        if path == b"/metrics":
+            status, body = "200 OK", (await expose()).encode()
+        else:
+            status, body = "404 Not Found", b""
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def _expose() -> str:
+    return REGISTRY.expose()
+
+
+async def serve(host: str, port: int, expose: Callable[[], Awaitable[str]] = _expose) -> Optional[asyncio.AbstractServer]:
+    """ 在host:port/metrics导出指标，并开始统计事件循环延迟 """
+    asyncio.create_task(_measure_loop_lag())
+    if not port:
+        return None
+    return await asyncio.start_server(functools.partial(_handle, expose=expose), host, port)
@@ -1,91 +1,522 @@
+import os
+import time
+import atexit
+import signal
+import asyncio
+from typing import Optional, Union
+
 import yaml
 
-from api import *
+import log
+import capture
+import metrics
+import tracing
+from api import close_clients, FetchAPI, GetMyProfile, GetFriendRequest, GetGroupRequest, GroupKick, GroupAdmin, GroupLeave
 from event import event_mapping
 from utils import MkIXMessageMemo, RequestMemo, Tools
-from ws import MkIXConnect, OneBotConnect
-from model import Config, MyProfile, OB11ActionData
-from action import action_mapping, FriendAddRequest, GroupAddRequest
+from members import MemberIndex, MEMBER, ADMIN
+from ws import WSSupervisor
+from model import Config, MyProfile, OB11ActionData, MkIXPostMessage
+from action import action_mapping, ACTIONS, RevokeBatch, FriendAddRequest, GroupAddRequest
 
+REQUEST_SWEEP_CONCURRENCY = 8
+PROFILE_RETRY_DELAY = 5         # 使用快照启动后刷新账号信息失败时的重试间隔，单位: s
+PROFILE_RETRY_DELAY_MAX = 300   # 重试间隔的上限，单位: s
+METRICS_HOST = "127.0.0.1"
+RATE_LIMITED_SUFFIX = "_rate_limited"
+CONFIG_PATH = "config.yaml"
+# 重新加载config.yaml时立即生效的账号字段，其余字段需要重新登录或重新连接，即重启
+RELOADABLE = {"max_memo_size", "webp", "image_max_size", "encrypt", "shutdown_timeout", "profile_snapshot",
+              "event_filter", "rate_limit"}
+# 进程级字段，以第一个账号为准
+PROCESS_FIELDS = {"log_rate", "log_json", "metrics_port", "uvloop", "trace_path", "capture_path", "config_watch"}
+PROCESS_RELOADABLE = {"log_rate", "log_json", "trace_path", "capture_path"}
+RUNTIME_FIELDS = {"token", "ws_check"}  # 运行时写入，不来自配置文件
 
-class MkXI:
+
+class Bot:
+    """ 一个账号的连接与状态，在各自的Task中运行，FetchAPI等实例只在该Task及其子Task中可见 """
     _memo: MkIXMessageMemo
     _config: Config
     _my_profile: MyProfile
 
-    def __init__(self):
-        self._load_config()
+    def __init__(self, config: Config):
+        self._config = config
+        self._supervisor: Optional[WSSupervisor] = None
+        self._actions: set[asyncio.Task] = set()    # 正在处理的Action，关闭时等待完成
+        self._background: set[asyncio.Task] = set()     # 重试刷新资料等后台任务，关闭时取消
+        self._closing = False
 
-    def _load_config(self):
+    async def _set_up(self):
+        self._fetcher = FetchAPI(self._config).get_instance()
+        self._launch_time = Tools.timestamp()
+        self._request_memo = RequestMemo().get_instance()
+        self._members = MemberIndex().get_instance()
+        self._memo = MkIXMessageMemo(self._config).get_instance()
+        self._supervisor = WSSupervisor(self._config, self._mkix_message_handler, self._onebot_message_handler)
+        self._MkIXConnect = self._supervisor.mkix
+        self._OneBotConnect = self._supervisor.onebot
+        self._config.ws_check = self._supervisor.health.snapshot
+
+        # 登录由第一个需要token的请求触发，并发的请求共用同一次登录
+        profile = asyncio.create_task(self._refresh_profile())
+        self._my_profile = self._load_profile_snapshot()
+        if self._my_profile is None:
+            await profile
+        await self._supervisor.start()
         try:
-            with open('config.yaml', 'r', encoding='utf-8') as F:
-                config = yaml.safe_load(F)
-                config["encrypt"] = {str(k): v for k, v in config["encrypt"].items()} if config["encrypt"] else {}
-                self._config = Config.model_validate(config)
+            await profile
         except Exception as e:
-            Tools.logger().error(f"Error when loading config: {e}")
+            # 连接已建立，继续使用快照，在后台重试
+            Tools.logger().error(f"Error when refreshing profile, using snapshot: {e}")
+            self._run_background(self._retry_refresh_profile())
+        self._run_background(self._fetch_requests())
 
-    async def _set_up(self):
-        self._fetcher = FetchAPI(self._config).get_instance()
-        res = await self._fetcher.call(Login)
-        self._config.token = f"Bearer {res['access_token']}"
+    def _run_background(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _load_profile_snapshot(self) -> Optional[MyProfile]:
+        path = self._config.profile_snapshot
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as F:
+                return MyProfile.model_validate_json(F.read())
+        except Exception as e:
+            Tools.logger().error(f"Error when loading profile snapshot: {e}")
+            return None
+
+    async def _refresh_profile(self):
         res = await self._fetcher.call(GetMyProfile)
         res["groups"] = {i["group"] for i in res["groups"]}
         res["friends"] = {i["uuid"] for i in res["friends"]}
         self._my_profile = MyProfile.model_validate(res)
+        self._save_profile_snapshot()
 
-        self._launch_time = Tools.timestamp()
-        self._request_memo = RequestMemo().get_instance()
-        self._memo = MkIXMessageMemo(self._config).get_instance()
-        self._MkIXConnect = await MkIXConnect.create(self._config, self._mkix_message_handler)
-        self._OneBotConnect = await OneBotConnect.create(self._config, self._onebot_message_handler)
-        self._config.ws_check = self._MkIXConnect.can_send
-        asyncio.create_task(self._fetcher.call(GetFriendRequest))
-        for i in self._my_profile.groups:
-            asyncio.create_task(self._fetcher.call(GetGroupRequest, group=i))
+    async def _retry_refresh_profile(self):
+        delay = PROFILE_RETRY_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._refresh_profile()
+                Tools.logger().info("Profile refreshed")
+                return
+            except Exception as e:
+                Tools.logger().error(f"Error when refreshing profile: {e}")
+                delay = min(PROFILE_RETRY_DELAY_MAX, delay * 2)
+
+    def _save_profile_snapshot(self):
+        path = self._config.profile_snapshot
+        if path:
+            try:
+                with open(path, 'w', encoding='utf-8') as F:
+                    F.write(self._my_profile.model_dump_json())
+            except Exception as e:
+                Tools.logger().error(f"Error when saving profile snapshot: {e}")
+
+    async def _fetch_requests(self):
+        """ 获取未处理的好友/加群请求，限制并发数 """
+        semaphore = asyncio.Semaphore(REQUEST_SWEEP_CONCURRENCY)
+
+        async def fetch(cls, **kwargs):
+            async with semaphore:
+                await self._fetcher.call(cls, **kwargs)
+
+        res = await asyncio.gather(
+            fetch(GetFriendRequest),
+            *[fetch(GetGroupRequest, group=i) for i in self._my_profile.groups],
+            return_exceptions=True,
+        )
+        for i in res:
+            if isinstance(i, Exception):
+                Tools.logger().error(f"Fetch request error: {i}")
 
     async def _mkix_message_handler(self, message):
-        event = await event_mapping(message, self._launch_time, self._config, self._my_profile)
+        metrics.ACCOUNT_LOAD.inc(self._config.account)
+        with metrics.EVENT_LATENCY.time():
+            event = await event_mapping(message, self._launch_time, self._config, self._my_profile)
         if event:
+            metrics.EVENTS.inc(event["post_type"])
             asyncio.create_task(self._OneBotConnect.send(event))
 
     async def _onebot_message_handler(self, message: dict):
+        metrics.ACCOUNT_LOAD.inc(self._config.account)
+        if self._closing:
+            metrics.ACTIONS.inc(_action_label(message.get("action")), "rejected")
+            asyncio.create_task(self._OneBotConnect.send({
+                'status': 'failed',
+                'retcode': 1400,
+                'data': {"detail": "Shutting down"},
+                'echo': message.get("echo"),
+            }))
+            return
+        task = asyncio.current_task()
+        self._actions.add(task)
+        try:
+            await self._dispatch_action(message)
+        finally:
+            self._actions.discard(task)
+
+    async def _dispatch_action(self, message: dict):
+        action = message.get("action", "")
+        tracing.correlate(f"ob-{message.get('echo')}")
+        # 限速调用：立即返回async，排队等待令牌后执行，不再返回结果
+        queued = action.endswith(RATE_LIMITED_SUFFIX)
+        if queued:
+            action = action.removesuffix(RATE_LIMITED_SUFFIX)
+            message = {**message, "action": action}
+            asyncio.create_task(self._OneBotConnect.send({
+                'status': 'async',
+                'retcode': 1,
+                'data': None,
+                'echo': message.get("echo"),
+            }))
+        with metrics.ACTION_LATENCY.time(_action_label(action)), tracing.span("onebot_action", action=action) as span:
+            await self._handle_action(message, span, queued)
+
+    async def _acquire(self, operation: Union[list[MkIXPostMessage], dict], queued: bool):
+        """ 消息按拆分后的条数获取令牌，不访问Mk.IX的Action不限速 """
+        if isinstance(operation, list):
+            conversation, n = (operation[0].group if operation else None), max(1, len(operation))
+        elif isinstance(operation, RevokeBatch):
+            conversation, n = None, max(1, sum(len(i) for i in operation.values() if isinstance(i, list)))
+        elif operation["cls"]._requires_token and not operation["cls"].cached(operation):
+            conversation, n = operation.get("group_id"), 1
+        else:
+            return
+        if queued:
+            await self._fetcher.rate_limiter.acquire(conversation, n)
+        else:
+            self._fetcher.rate_limiter.acquire_nowait(conversation, n)
+
+    async def _handle_action(self, message: dict, span: tracing.span, queued: bool = False):
+        def reply(content: dict):
+            if not queued:
+                asyncio.create_task(self._OneBotConnect.send({**content, 'echo': message["echo"]}))
+
         try:
             operation = await action_mapping(OB11ActionData.model_validate(message))
+            await self._acquire(operation, queued)
             if isinstance(operation, list):     # 该Action通过ws发送
                 ret = await self._memo.post_messages(operation, message["action"], self._MkIXConnect)
-                asyncio.create_task(self._OneBotConnect.send({
+                span["message_id"] = ret.get("message_id")
+                reply({
                     'status': 'ok',
                     'retcode': 0,
                     'data': ret,
-                    'echo': message["echo"],
-                }))
+                })
+            elif isinstance(operation, RevokeBatch):    # 批量撤回，所有撤回请求一起发送
+                revoked = await self._memo.revoke_messages(
+                    {k: v for k, v in operation.items() if isinstance(v, list)}, self._MkIXConnect)
+                results = []
+                for k, v in operation.items():
+                    if k in revoked:
+                        results.append({"message_id": k, "status": "ok" if revoked[k] else "failed"})
+                    else:
+                        results.append({"message_id": k, "status": "failed", "detail": v})
+                reply({
+                    'status': 'ok',
+                    'retcode': 0,
+                    'data': {"results": results},
+                })
             elif isinstance(operation, dict):   # 该Action通过http发送
                 ret = await self._fetcher.call(**operation)
                 if operation["cls"] == FriendAddRequest and operation["approve"]:
                     self._my_profile.friends.add(operation["user_id"])
                 elif operation["cls"] == GroupAddRequest and operation["approve"]:
                     self._my_profile.groups.add(operation["group_id"])
-                asyncio.create_task(self._OneBotConnect.send({
+                elif operation["cls"] == GroupKick:
+                    self._members.leave(operation["group_id"], operation["user_id"])
+                elif operation["cls"] == GroupAdmin:
+                    self._members.set_role(operation["group_id"], operation["user_id"],
+                                           ADMIN if operation["enable"] else MEMBER)
+                elif operation["cls"] == GroupLeave:
+                    self._members.drop(operation["group_id"])
+                reply({
                     'status': 'ok',
                     'retcode': 0,
                     'data': ret,
-                    'echo': message["echo"],
-                }))
+                })
+            metrics.ACTIONS.inc(_action_label(message["action"]), "ok")
         except Exception as e:
+            metrics.ACTIONS.inc(_action_label(message.get("action")), "failed")
             Tools.logger().error(f"Action error: {e}")
-            asyncio.create_task(self._OneBotConnect.send({
+            reply({
                 'status': 'failed',
                 'retcode': 1400,
                 'data': {"detail": str(e)},
-                'echo': message["echo"],
-            }))
+            })
 
-    async def run(self):
+    async def run(self, bind_log: bool = False):
         try:
+            if bind_log:
+                log.bind_account(self._config.account)
             await self._set_up()
             Tools.logger().info("Set up success")
             while True:
                 await asyncio.sleep(5)
         except Exception as e:
             Tools.logger().error(f"Error: {e}")
+
+    def reload(self, config: Config) -> tuple[list[str], list[str]]:
+        """ 同步地替换字段并重建派生的结构，其他协程不会读到一半新一半旧的配置；返回(已生效, 需要重启)的字段 """
+        changed = [k for k in Config.model_fields
+                   if k not in RUNTIME_FIELDS | PROCESS_FIELDS and getattr(self._config, k) != getattr(config, k)]
+        applied = [k for k in changed if k in RELOADABLE]
+        for k in applied:
+            setattr(self._config, k, getattr(config, k))
+        if "encrypt" in applied:
+            self._config._cipher = config.cipher
+        if "rate_limit" in applied and hasattr(self, "_fetcher"):
+            self._fetcher.rate_limiter.configure(self._config.rate_limit)
+        if hasattr(self, "_memo"):
+            self._memo.reload()
+        return applied, [k for k in changed if k not in RELOADABLE]
+
+    async def shutdown(self, deadline: float) -> None:
+        """ 不再接受新的Action，在deadline(time.monotonic())之前等待已收到的Action、echo及发往OneBot的消息 """
+        self._closing = True
+        try:
+            if self._actions:
+                _, pending = await asyncio.wait(self._actions, timeout=max(0.0, deadline - time.monotonic()))
+                if pending:
+                    Tools.logger().error(f"Shutdown timeout, {len(pending)} actions unfinished")
+            if self._supervisor is None:
+                return
+            if not await self._OneBotConnect.drain(deadline - time.monotonic()):
+                Tools.logger().error("Shutdown timeout, OneBot messages unsent")
+            if getattr(self, "_my_profile", None) is not None:
+                self._save_profile_snapshot()
+            await self._supervisor.close()
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        """ 取消后台任务，停止发送队列并注销指标回调，可重复调用；_set_up中途失败时只清理已创建的实例 """
+        for task in list(self._background):
+            task.cancel()
+        for name in ("_memo", "_members"):
+            instance = getattr(self, name, None)
+            if instance is not None:
+                instance.close()
+        if getattr(self, "_fetcher", None) is not None:
+            self._fetcher.rate_limiter.close()
+
+
+class MkXI:
+    """ 进程内的各账号共用HTTP连接池、线程池、缓存与指标 """
+    _configs: list[Config]
+
+    def __init__(self, accounts: Optional[list[str]] = None, shard: Optional[int] = None,
+                 metrics_port: Optional[int] = None, accounts_file: Optional[str] = None):
+        """ 只运行accounts或accounts_file(每行一个账号)中的账号，shard为supervisor.py的worker编号 """
+        self._accounts = accounts
+        self._accounts_file = accounts_file
+        self._shard = shard
+        self._metrics_port = metrics_port
+        self._configs = []
+        self._bots: dict[str, Bot] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._stopping: set[asyncio.Task] = set()   # 正在停止的账号
+        self._stop: Optional[asyncio.Event] = None
+        self._bind_log = False
+        self._mtime = (0.0, 0.0)
+        self._load_config()
+
+    def _mtimes(self) -> tuple[float, float]:
+        return _mtime(CONFIG_PATH), _mtime(self._accounts_file) if self._accounts_file else 0.0
+
+    def _read_config(self) -> list[Config]:
+        self._mtime = self._mtimes()
+        with open(CONFIG_PATH, 'r', encoding='utf-8') as F:
+            config = yaml.safe_load(F)
+        # 多账号模式下，每个账号的配置为顶层配置加上该账号的覆盖项
+        configs = [Config.model_validate(_normalize({**config, **i})) for i in config.pop("accounts", None) or [{}]]
+        accounts = self._accounts
+        if self._accounts_file:
+            with open(self._accounts_file, 'r', encoding='utf-8') as F:
+                accounts = F.read().split()
+        if accounts is not None:
+            configs = [i for i in configs if i.account in accounts]
+        accounts = [i.account for i in configs]
+        if len(set(accounts)) != len(accounts):
+            raise ValueError("Duplicate account")
+        snapshots = [i.profile_snapshot for i in configs if i.profile_snapshot]
+        if len(set(snapshots)) != len(snapshots):
+            raise ValueError("Each account needs its own profile_snapshot")
+        return configs
+
+    def _load_config(self):
+        try:
+            self._configs = self._read_config()
+            config = self._configs[0]
+            log.configure(config.log_rate, self._shard_path(config.log_json))
+            tracing.configure(self._shard_path(config.trace_path))
+            atexit.register(tracing.flush)
+            capture.configure(self._shard_path(config.capture_path))
+            atexit.register(capture.close)
+        except Exception as e:
+            Tools.logger().error(f"Error when loading config: {e}")
+
+    def reload(self) -> None:
+        """ 重新读取config.yaml，所有账号的配置都校验通过后才应用，只有增减的账号登录或退出，其余不重新连接 """
+        try:
+            configs = {i.account: i for i in self._read_config()}
+        except Exception as e:
+            metrics.CONFIG_RELOADS.inc("failed")
+            Tools.logger().error(f"Error when reloading config, keeping the current one: {e}")
+            return
+        if not configs:     # 账号被改名或删除
+            metrics.CONFIG_RELOADS.inc("failed")
+            Tools.logger().error("No account to run in config.yaml, keeping the current one")
+            return
+        current, new = self._configs[0], next(iter(configs.values()))
+        if new.log_rate != current.log_rate or new.log_json != current.log_json:
+            log.configure(new.log_rate, self._shard_path(new.log_json))
+        if new.trace_path != current.trace_path:
+            tracing.configure(self._shard_path(new.trace_path))
+        if new.capture_path != current.capture_path:
+            capture.configure(self._shard_path(new.capture_path))
+        for i in self._configs:
+            for k in PROCESS_RELOADABLE:
+                setattr(i, k, getattr(new, k))
+        restart = [k for k in sorted(PROCESS_FIELDS - PROCESS_RELOADABLE) if getattr(current, k) != getattr(new, k)]
+
+        removed = [i for i in self._bots if i not in configs]
+        for account in removed:
+            self._stop_bot(account)
+        for account, bot in self._bots.items():
+            applied, pending = bot.reload(configs[account])
+            if applied or pending:
+                Tools.logger().info(f"Config reloaded for {account}, applied: {applied}, restart required: {pending}")
+        added = [i for i in configs if i not in self._bots]
+        for account in added:
+            self._start_bot(configs[account])
+        if removed or added:
+            Tools.logger().info(f"Accounts stopped: {removed}, started: {added}")
+        self._configs = [i._config for i in self._bots.values()]
+        metrics.CONFIG_RELOADS.inc("ok")
+        if restart:
+            Tools.logger().warning(f"Config reloaded, restart required: {restart}")
+        else:
+            Tools.logger().info("Config reloaded")
+
+    async def _watch_config(self, interval: float):
+        """ config.yaml或accounts_file的修改时间变化时重新加载 """
+        while True:
+            await asyncio.sleep(interval)
+            if self._mtimes() != self._mtime:
+                self.reload()
+
+    def _start_bot(self, config: Config) -> None:
+        # 每个账号一个Task，各自的上下文互不影响
+        bot = self._bots[config.account] = Bot(config)
+        task = self._tasks[config.account] = asyncio.create_task(bot.run(bind_log=self._bind_log))
+        task.add_done_callback(self._on_bot_done)
+        metrics.ACCOUNT_LOAD.inc(config.account, value=0)
+
+    def _on_bot_done(self, _):
+        # 所有账号都启动失败时也退出
+        if all(i.done() for i in self._tasks.values()):
+            self._stop.set()
+
+    def _stop_bot(self, account: str) -> None:
+        """ 停止从配置中删除或迁移到其他worker的账号 """
+        bot, task = self._bots.pop(account), self._tasks.pop(account)
+
+        async def stop():
+            try:
+                await bot.shutdown(time.monotonic() + bot._config.shutdown_timeout)
+            except Exception as e:
+                Tools.logger().error(f"Error when stopping {account}: {e}")
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            bot._close()    # Task结束后再次释放，shutdown失败时也不遗留后台任务及指标回调
+            if account not in self._bots:   # 停止期间可能又被加回
+                metrics.ACCOUNT_LOAD.remove(account)
+
+        stopping = asyncio.create_task(stop())
+        self._stopping.add(stopping)
+        stopping.add_done_callback(self._stopping.discard)
+
+    def _shard_path(self, path: Optional[str]) -> Optional[str]:
+        """ 各worker写入不同的文件，例: trace.json -> trace.1.json """
+        if not path or self._shard is None:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{self._shard}{ext}"
+
+    def install_loop(self, force: bool = False) -> None:
+        """ 在asyncio.run之前调用，配置或命令行启用uvloop时替换事件循环 """
+        if not (force or self._configs and self._configs[0].uvloop):
+            return
+        try:
+            import uvloop
+        except ImportError:
+            Tools.logger().warning("uvloop is not installed, using the default asyncio event loop")
+            return
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    def _profile(self):
+        path = tracing.profile()
+        if path:
+            Tools.logger().info(f"Profiling for {tracing.PROFILE_SECONDS}s, output: {path}")
+
+    async def run(self):
+        try:
+            loop = type(asyncio.get_running_loop())
+            metrics.EVENT_LOOP.set(f"{loop.__module__}.{loop.__name__}", value=1)
+            Tools.logger().info(f"Event loop: {loop.__module__}.{loop.__name__}")
+            port = self._configs[0].metrics_port if self._metrics_port is None else self._metrics_port
+            await metrics.serve(METRICS_HOST, port)
+            if hasattr(signal, "SIGUSR1"):
+                asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self._profile)
+            if hasattr(signal, "SIGHUP"):
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+            if self._configs[0].config_watch > 0:
+                asyncio.create_task(self._watch_config(self._configs[0].config_watch))
+            self._stop = asyncio.Event()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    asyncio.get_running_loop().add_signal_handler(sig, self._stop.set)
+                except NotImplementedError:     # Windows，由KeyboardInterrupt直接结束
+                    pass
+            self._bind_log = len(self._configs) > 1 or self._accounts_file is not None
+            for i in self._configs:
+                self._start_bot(i)
+            if self._mtimes() != self._mtime:   # 安装SIGHUP处理函数之前配置已被修改
+                self.reload()
+            await self._stop.wait()
+
+            Tools.logger().info("Shutting down...")
+            start = time.monotonic()
+            bots, tasks = list(self._bots.values()), list(self._tasks.values())
+            await asyncio.gather(*[i.shutdown(start + i._config.shutdown_timeout) for i in bots], *self._stopping)
+            for i in tasks:
+                i.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await close_clients()
+            capture.close()
+            tracing.flush()
+            Tools.logger().info(f"Shutdown in {time.monotonic() - start:.2f}s")
+        except Exception as e:
+            Tools.logger().error(f"Error: {e}")
+
+
+def _action_label(action) -> str:
+    """ action由OneBot客户端传入，不在ACTIONS中的归为unknown，避免指标的序列数无限增长 """
+    return action if isinstance(action, str) and action in ACTIONS else "unknown"
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+def _normalize(config: dict) -> dict:
+    config["encrypt"] = {str(k): v for k, v in config["encrypt"].items()} if config.get("encrypt") else {}
+    return config
@@ -1,7 +1,42 @@
 import hashlib
 from typing import Optional, Any, Literal, Union
 
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, PrivateAttr, validator
+
+from crypto import Cipher, KEY_SIZES
+
+
+class EventFilter(BaseModel):
+    """ 空集合为不限制 """
+    post_type: set[str] = set()     # 只上报这些post_type
+    notice_type: set[str] = set()   # 不上报这些notice_type
+    allow: set[str] = set()         # 只上报这些群/好友的事件
+    deny: set[str] = set()          # 不上报这些群/好友的事件
+    sender_deny: set[str] = set()   # 不上报这些用户触发的事件
+
+    @validator("*", pre=True)
+    def _convert_ids(cls, v):
+        return {str(i) for i in v} if v else set()
+
+    def blocks(self, post_type: str, detail_type: Optional[str], conversation: Optional[str], sender: Optional[str]) -> bool:
+        if self.post_type and post_type not in self.post_type:
+            return True
+        if post_type == "notice" and detail_type in self.notice_type:
+            return True
+        if conversation is not None:
+            if self.allow and conversation not in self.allow:
+                return True
+            if conversation in self.deny:
+                return True
+        return sender is not None and sender in self.sender_deny
+
+
+class RateLimit(BaseModel):
+    """ 令牌桶，速率为0时不限制 """
+    rate: float = 0                 # 全局每秒最多发送的消息及HTTP请求数
+    burst: int = 20                 # 全局最多连续发送的数量
+    conversation_rate: float = 0    # 每个群/好友每秒最多发送的消息及HTTP请求数
+    conversation_burst: int = 5     # 每个群/好友最多连续发送的数量
 
 
 class Config(BaseModel):
@@ -12,10 +47,31 @@ class Config(BaseModel):
     max_memo_size: int
     ssl_check: bool
     webp: bool
+    image_max_size: int = 2048
     encrypt: dict[str, str]
+    heartbeat_interval: int = 30
+    shutdown_timeout: float = 10
+    profile_snapshot: Optional[str] = None
+    log_rate: int = 0
+    log_json: Optional[str] = None
+    metrics_port: int = 0
+    uvloop: bool = False
+    trace_path: Optional[str] = None
+    capture_path: Optional[str] = None
+    config_watch: float = 0
+    event_filter: EventFilter = EventFilter()
+    rate_limit: RateLimit = RateLimit()
 
     token: str = ""
     ws_check: Any = None
+    _cipher: Cipher = PrivateAttr()
+
+    def model_post_init(self, __context):
+        self._cipher = Cipher(self.encrypt)
+
+    @property
+    def cipher(self) -> Cipher:
+        return self._cipher
 
     @validator("account", pre=True)
     def _convert_account(cls, v):
@@ -29,6 +85,17 @@ class Config(BaseModel):
     def _convert_max_memo_size(cls, v):
         return int(v)
 
+    @validator("event_filter", "rate_limit", pre=True)
+    def _convert_section(cls, v):
+        return v or {}
+
+    @validator("encrypt")
+    def _check_encrypt(cls, v):
+        for k, key in v.items():
+            if len(key.encode("utf-8")) not in KEY_SIZES:
+                raise ValueError(f"Key of {k} must be {'/'.join(map(str, KEY_SIZES))} bytes")
+        return v
+
 
 class MyProfile(BaseModel):
     uuid: str
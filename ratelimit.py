@@ -0,0 +1,123 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Optional
+
+import metrics
+from model import RateLimit
+
+RATE_LIMIT_MIN_RATIO = 0.1          # 降速后的最低速率与配置速率之比
+RATE_LIMIT_RECOVER = 30             # 降速后恢复到配置速率所需的时长，单位: s
+RATE_LIMIT_MAX_CONVERSATIONS = 4096  # 最多记录的会话令牌桶数，超出后丢弃最久未使用的
+RATE_LIMIT_QUEUE_SIZE = 256         # 最多排队等待令牌的请求数
+
+
+def _key(conversation) -> str:
+    # OneBot传入的group_id为int，Mk.IX的为str
+    return str(conversation)
+
+
+class RateLimitedError(RuntimeError):
+    """ 令牌不足或排队已满 """
+    pass
+
+
+class TokenBucket:
+    """ 服务器限流或响应变慢时速率减半，之后线性恢复 """
+
+    def __init__(self, rate: float, burst: int):
+        self._base = rate
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        self._rate = min(self._base, self._rate + self._base * elapsed / RATE_LIMIT_RECOVER)
+        self._tokens = min(self._burst, self._tokens + self._rate * elapsed)
+
+    def wait_time(self, n: int) -> float:
+        """ 获得n个令牌还需等待的秒数，n超过burst时按burst计算 """
+        self._refill()
+        n = min(n, self._burst)
+        return 0.0 if self._tokens >= n else (n - self._tokens) / self._rate
+
+    def take(self, n: int) -> None:
+        self._tokens -= min(n, self._burst)
+
+    def throttle(self) -> None:
+        self._refill()
+        self._rate = max(self._base * RATE_LIMIT_MIN_RATIO, self._rate / 2)
+        self._tokens = min(self._tokens, 0.0)
+
+
+class RateLimiter:
+    """ 全局及每个会话的令牌桶，两者都有令牌时才放行 """
+
+    def __init__(self, config: RateLimit):
+        self.configure(config)
+        self._waiting = 0
+        self._gauge = lambda: self._waiting
+        metrics.QUEUE_DEPTH.add_function("rate_limit", func=self._gauge)
+
+    def close(self) -> None:
+        metrics.QUEUE_DEPTH.remove_function("rate_limit", func=self._gauge)
+
+    def configure(self, config: RateLimit) -> None:
+        """ 重新加载配置时以新的速率重建令牌桶，排队中的请求按新的令牌桶等待 """
+        self._config = config
+        self._global = TokenBucket(config.rate, config.burst) if config.rate > 0 else None
+        self._conversations: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def _buckets(self, conversation: Optional[str]) -> list[TokenBucket]:
+        ret = [self._global] if self._global else []
+        if conversation is not None and self._config.conversation_rate > 0:
+            conversation = _key(conversation)
+            bucket = self._conversations.get(conversation)
+            if bucket is None:
+                bucket = self._conversations[conversation] = TokenBucket(
+                    self._config.conversation_rate, self._config.conversation_burst)
+                if len(self._conversations) > RATE_LIMIT_MAX_CONVERSATIONS:
+                    self._conversations.popitem(last=False)
+            else:
+                self._conversations.move_to_end(conversation)
+            ret.append(bucket)
+        return ret
+
+    def try_acquire(self, conversation: Optional[str] = None, n: int = 1) -> bool:
+        buckets = self._buckets(conversation)
+        if any(i.wait_time(n) for i in buckets):
+            return False
+        for i in buckets:
+            i.take(n)
+        return True
+
+    def acquire_nowait(self, conversation: Optional[str] = None, n: int = 1) -> None:
+        if not self.try_acquire(conversation, n):
+            metrics.RATE_LIMITED.inc("rejected")
+            raise RateLimitedError(f"Rate limited: {conversation or 'global'}")
+
+    async def acquire(self, conversation: Optional[str] = None, n: int = 1) -> None:
+        """ 等待直到获得令牌 """
+        if self.try_acquire(conversation, n):
+            return
+        if self._waiting >= RATE_LIMIT_QUEUE_SIZE:
+            metrics.RATE_LIMITED.inc("rejected")
+            raise RateLimitedError("Rate limit queue is full")
+        metrics.RATE_LIMITED.inc("queued")
+        self._waiting += 1
+        try:
+            while not self.try_acquire(conversation, n):
+                await asyncio.sleep(max(i.wait_time(n) for i in self._buckets(conversation)))
+        finally:
+            self._waiting -= 1
+
+    def throttle(self, conversation: Optional[str] = None) -> None:
+        """ 服务器返回429或echo变慢时降速 """
+        metrics.RATE_LIMITED.inc("throttled")
+        if self._global:
+            self._global.throttle()
+        if conversation is not None and _key(conversation) in self._conversations:
+            self._conversations[_key(conversation)].throttle()
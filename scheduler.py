@@ -0,0 +1,81 @@
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, Optional
+
+import metrics
+
+SEND_QUEUE_SIZE = 64    # 排队的消息批次上限，满时post_messages等待
+# 消息类型 -> 通道，批次取其中最慢的通道
+LANES = {"revokeRequest": "revoke", "text": "text", "image": "image", "file": "file", "audio": "file"}
+# 通道 -> 权重，按权重比例轮流发送，低权重的通道不会被饿死
+LANE_WEIGHTS = {"revoke": 8, "text": 4, "image": 2, "file": 1}
+
+
+def lane_of(types: list[str]) -> str:
+    order = list(LANE_WEIGHTS)
+    return max((LANES.get(i, "text") for i in types), key=order.index, default="text")
+
+
+class _Lane:
+    """ 每个会话一个FIFO，会话之间轮流发送 """
+
+    def __init__(self, weight: int):
+        self.weight = weight
+        self.passes = 0.0   # 虚拟时间，每发送一批增加1/weight
+        self.size = 0
+        self._conversations: OrderedDict[Optional[str], deque] = OrderedDict()
+
+    def put(self, conversation: Optional[str], item) -> None:
+        self._conversations.setdefault(conversation, deque()).append(item)
+        self.size += 1
+
+    def get(self):
+        conversation, items = next(iter(self._conversations.items()))
+        item = items.popleft()
+        if items:
+            self._conversations.move_to_end(conversation)
+        else:
+            del self._conversations[conversation]
+        self.size -= 1
+        self.passes += 1 / self.weight
+        return item
+
+
+class Scheduler:
+    """ 代替FIFO的发送队列：通道之间按权重调度，通道内各会话公平轮转 """
+
+    def __init__(self, maxsize: int = SEND_QUEUE_SIZE):
+        self._lanes = {k: _Lane(v) for k, v in LANE_WEIGHTS.items()}
+        self._slots = asyncio.Semaphore(maxsize)
+        self._ready = asyncio.Event()
+        self._gauges = {f"send_{name}": lambda lane=lane: lane.size for name, lane in self._lanes.items()}
+        for name, func in self._gauges.items():
+            metrics.QUEUE_DEPTH.add_function(name, func=func)
+
+    def close(self) -> None:
+        for name, func in self._gauges.items():
+            metrics.QUEUE_DEPTH.remove_function(name, func=func)
+
+    def qsize(self) -> int:
+        return sum(i.size for i in self._lanes.values())
+
+    async def put(self, item: Any, lane: str, conversation: Optional[str] = None) -> None:
+        await self._slots.acquire()
+        target = self._lanes[lane]
+        if not target.size:
+            # 空闲后重新加入的通道不累积之前的份额
+            busy = [i.passes for i in self._lanes.values() if i.size]
+            target.passes = max(target.passes, min(busy, default=target.passes))
+        target.put(conversation, (item, lane, time.perf_counter()))
+        self._ready.set()
+
+    async def get(self) -> Any:
+        while not self.qsize():
+            self._ready.clear()
+            await self._ready.wait()
+        lane = min((i for i in self._lanes.values() if i.size), key=lambda i: i.passes)
+        item, name, enqueued = lane.get()
+        self._slots.release()
+        metrics.SEND_WAIT.observe(name, value=time.perf_counter() - enqueued)
+        return item
@@ -0,0 +1,280 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+from typing import Optional
+
+import yaml
+
+import log
+import metrics
+
+METRICS_HOST = "127.0.0.1"
+RESTART_DELAY = 1           # worker退出后重启的初始间隔，单位: s
+RESTART_DELAY_MAX = 60      # 重启间隔的上限，单位: s
+STABLE_INTERVAL = 30        # worker运行超过该时长才重置重启间隔，单位: s
+STOP_TIMEOUT = 30           # 停止worker时等待其退出的时长，超时后kill，单位: s
+REBALANCE_INTERVAL = 300    # 根据各账号的负载重新分配的间隔，单位: s
+REBALANCE_THRESHOLD = 1.5   # 最忙的worker负载超过平均值的该倍数时才重新分配
+REBALANCE_MAX_MOVES = 4     # 每次最多迁移的账号数，迁移的账号需要重新登录，其余账号不受影响
+SCRAPE_TIMEOUT = 2          # 读取worker指标的超时，单位: s
+SHUTDOWN_TIMEOUT = 10       # config.yaml未设置shutdown_timeout时的默认值，单位: s
+MIGRATE_GRACE = 5           # 迁移账号时在shutdown_timeout之外额外等待原worker重新加载的时长，单位: s
+MIGRATE_POLL_INTERVAL = 0.5  # 迁移账号时检查原worker中账号是否退出的间隔，单位: s
+WORKER_LOG_WIDTH = 200      # worker的输出不是终端，rich默认按80列换行
+WORKER_LINE_LIMIT = 1 << 20  # 转发worker输出时单行的上限，超出的部分被丢弃，单位: B
+
+REGISTRY = metrics.Registry()     # 只导出supervisor自身的指标，其余由各worker汇总
+WORKER_UP = REGISTRY.gauge("mkxi_worker_up", "Worker process is running", ("shard",))
+WORKER_RESTARTS = REGISTRY.counter("mkxi_worker_restarts_total", "Worker restarts", ("shard", "reason"))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind((METRICS_HOST, 0))
+        return s.getsockname()[1]
+
+
+def accounts_of(config: dict) -> list[str]:
+    """ 只读取账号，其余配置由worker校验 """
+    return [str(i.get("account", config.get("account"))) for i in config.get("accounts") or [{}]]
+
+
+def plan(assignment: list[list[str]], loads: dict[str, float]) -> list[list[str]]:
+    """ 从最忙的worker向最闲的worker迁移账号，直到负载均衡或达到迁移上限 """
+    ret = [list(i) for i in assignment]
+    for _ in range(REBALANCE_MAX_MOVES):
+        totals = [sum(loads.get(a, 0) for a in i) for i in ret]
+        mean = sum(totals) / len(totals)
+        busiest, idlest = totals.index(max(totals)), totals.index(min(totals))
+        if not mean or totals[busiest] <= REBALANCE_THRESHOLD * mean:
+            break
+        # 迁移后两者中较大的负载仍需下降，选能使其降得最多的账号
+        gap = totals[busiest] - totals[idlest]
+        candidates = [a for a in ret[busiest] if 0 < loads.get(a, 0) < gap]
+        if not candidates or len(ret[busiest]) <= 1:
+            break
+        account = max(candidates, key=lambda a: min(loads[a], gap - loads[a]))
+        ret[busiest].remove(account)
+        ret[idlest].append(account)
+    return ret
+
+
+class Worker:
+    """ 运行main.py的子进程，异常退出后重启，输出加上编号后转发 """
+
+    def __init__(self, shard: int, accounts: list[str], args: list[str], directory: str):
+        self.shard = shard
+        self.accounts = accounts
+        self.accounts_file = os.path.join(directory, f"worker-{shard}.accounts")
+        self.metrics_port = _free_port()
+        self._args = args
+        self._proc: Optional[asyncio.subprocess.Process] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def _write_accounts(self) -> None:
+        with open(self.accounts_file, 'w', encoding='utf-8') as F:
+            F.write("\n".join(self.accounts))
+
+    def start(self) -> None:
+        self._write_accounts()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        delay = RESTART_DELAY
+        while not self._stopping:
+            started = time.monotonic()
+            self._proc = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                "--accounts-file", self.accounts_file, "--shard", str(self.shard),
+                "--metrics-port", str(self.metrics_port), *self._args,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                env={**os.environ, "COLUMNS": str(WORKER_LOG_WIDTH)}, limit=WORKER_LINE_LIMIT,
+            )
+            WORKER_UP.set(str(self.shard), value=1)
+            await self._relay(self._proc.stdout)
+            code = await self._proc.wait()
+            WORKER_UP.set(str(self.shard), value=0)
+            if self._stopping:
+                break
+            WORKER_RESTARTS.inc(str(self.shard), "exit")
+            if time.monotonic() - started >= STABLE_INTERVAL:
+                delay = RESTART_DELAY
+            log.get_logger().error(f"Worker {self.shard} exited with {code}. Restarting in {delay}s...")
+            await asyncio.sleep(delay)
+            delay = min(RESTART_DELAY_MAX, delay * 2)
+
+    async def _relay(self, stream: asyncio.StreamReader):
+        prefix = f"[worker {self.shard}] ".encode()
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:  # 超过WORKER_LINE_LIMIT，已读取的部分被丢弃，继续转发之后的输出
+                line = f"(line longer than {WORKER_LINE_LIMIT}B dropped)\n".encode()
+            if not line:
+                break
+            sys.stdout.buffer.write(prefix + line)
+            sys.stdout.flush()
+
+    async def scrape(self) -> str:
+        """ 读取worker的/metrics，失败时返回空 """
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(METRICS_HOST, self.metrics_port), SCRAPE_TIMEOUT)
+            try:
+                writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+                await writer.drain()
+                response = await asyncio.wait_for(reader.read(), SCRAPE_TIMEOUT)
+            finally:
+                writer.close()
+            return response.split(b"\r\n\r\n", 1)[1].decode()
+        except Exception:
+            return ""
+
+    async def runs(self, account: str) -> bool:
+        """ worker导出该账号的mkxi_account_messages_total时账号仍在运行，无法读取指标时视为已退出 """
+        series = f'mkxi_account_messages_total{{account="{metrics._escape(account)}"}}'
+        return series in metrics.parse(await self.scrape())
+
+    async def _terminate(self):
+        if self._proc is None or self._proc.returncode is not None:
+            return
+        self._proc.terminate()
+        try:
+            await asyncio.wait_for(self._proc.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._proc.kill()
+
+    def signal(self, sig: int) -> None:
+        if self._proc is not None and self._proc.returncode is None:
+            self._proc.send_signal(sig)
+
+    def reassign(self, accounts: list[str]) -> None:
+        """ 写入新的账号后通知worker重新加载，只有增减的账号登录或退出 """
+        self.accounts = accounts
+        self._write_accounts()
+        self.signal(signal.SIGHUP)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        await self._terminate()
+        if self._task:
+            self._task.cancel()     # 可能在等待重启
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+class Supervisor:
+    """ 将账号分配到多个worker进程，汇总指标，定期按负载重新分配 """
+
+    def __init__(self, workers: int, args: list[str]):
+        with open('config.yaml', 'r', encoding='utf-8') as F:
+            config = yaml.safe_load(F)
+        self._metrics_port = config.get("metrics_port") or 0
+        self._shutdown_timeout = config.get("shutdown_timeout", SHUTDOWN_TIMEOUT)
+        accounts = accounts_of(config)
+        count = max(1, min(workers, len(accounts)))
+        self._dir = tempfile.mkdtemp(prefix="mkxi-supervisor-")   # 各worker的账号文件
+        self._workers = [Worker(i, accounts[i::count], args, self._dir) for i in range(count)]
+        self._last_load: dict[str, float] = {}
+        self._assigning = asyncio.Lock()     # 重新分配与重新加载依次进行
+        self._stopped = asyncio.Event()
+
+    async def _expose(self) -> str:
+        texts = await asyncio.gather(*[i.scrape() for i in self._workers])
+        return metrics.merge([*texts, REGISTRY.expose()])
+
+    async def _loads(self) -> dict[str, float]:
+        """ 距离上次调用各账号处理的消息数 """
+        current = {}
+        for text in await asyncio.gather(*[i.scrape() for i in self._workers]):
+            for k, v in metrics.parse(text).items():
+                if k.startswith("mkxi_account_messages_total{"):
+                    current[k.split('"')[1]] = v
+        # worker重启后计数从0开始
+        ret = {k: v - self._last_load.get(k, 0) if v >= self._last_load.get(k, 0) else v for k, v in current.items()}
+        self._last_load.update(current)
+        return ret
+
+    async def _rebalance(self):
+        await self._loads()
+        while True:
+            await asyncio.sleep(REBALANCE_INTERVAL)
+            loads = await self._loads()
+            async with self._assigning:
+                target = plan([i.accounts for i in self._workers], loads)
+                changed = [(w.shard, a) for w, a in zip(self._workers, target) if set(a) != set(w.accounts)]
+                if changed:
+                    log.get_logger().info(f"Rebalance: {changed}")
+                    await self._assign(target)
+
+    async def _assign(self, target: list[list[str]], reload: bool = False):
+        """ 先从原worker移除账号并等待其退出，再加入新的worker，同一账号不会同时在两个进程中登录
+        reload为True时账号未变化的worker也重新加载 """
+        moved = [(w, a) for w, t in zip(self._workers, target) for a in w.accounts
+                 if a not in t and any(a in i for i in target)]
+        for w, t in zip(self._workers, target):
+            kept = [a for a in w.accounts if a in t]
+            if kept != w.accounts:
+                w.reassign(kept)
+        if moved:
+            await asyncio.gather(*[self._wait_stopped(w, a) for w, a in moved])
+        for w, t in zip(self._workers, target):
+            if t != w.accounts:
+                log.get_logger().info(f"Worker {w.shard} accounts: {t}")
+                w.reassign(t)
+            elif reload:
+                w.signal(signal.SIGHUP)
+
+    async def _wait_stopped(self, worker: Worker, account: str):
+        deadline = time.monotonic() + self._shutdown_timeout + MIGRATE_GRACE
+        while await worker.runs(account):
+            if time.monotonic() >= deadline:
+                log.get_logger().error(f"Account {account} still running in worker {worker.shard}, migrating anyway")
+                return
+            await asyncio.sleep(MIGRATE_POLL_INTERVAL)
+
+    async def _reload(self):
+        """ 删除的账号从worker中移除，新增的账号分配给账号最少的worker，再由各worker自行重新加载 """
+        try:
+            with open('config.yaml', 'r', encoding='utf-8') as F:
+                config = yaml.safe_load(F)
+            accounts = accounts_of(config)
+            self._shutdown_timeout = config.get("shutdown_timeout", SHUTDOWN_TIMEOUT)
+        except Exception as e:
+            log.get_logger().error(f"Error when reloading config: {e}")
+            accounts = [a for i in self._workers for a in i.accounts]
+        async with self._assigning:
+            target = [[a for a in i.accounts if a in accounts] for i in self._workers]
+            for a in accounts:
+                if not any(a in i for i in target):
+                    min(target, key=len).append(a)
+            await self._assign(target, reload=True)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._stopped.set)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.create_task(self._reload()))
+        for i in self._workers:
+            i.start()
+        await metrics.serve(METRICS_HOST, self._metrics_port, self._expose)
+        rebalance = asyncio.create_task(self._rebalance())
+        log.get_logger().info(f"Started {len(self._workers)} workers: {[i.accounts for i in self._workers]}")
+        await self._stopped.wait()
+        rebalance.cancel()
+        await asyncio.gather(*[i.stop() for i in self._workers])
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker进程数，默认为CPU数")
+    parser.add_argument("worker_args", nargs="*", help="传给main.py的参数")
+    args = parser.parse_args()
+    asyncio.run(Supervisor(args.workers, args.worker_args).run())
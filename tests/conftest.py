@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from model import Config    # noqa: E402
+
+
+@pytest.fixture
+def config(tmp_path):
+    return Config.model_validate({
+        "account": "1234567890",
+        "password": "test",
+        "server_url": "http://127.0.0.1:8000",
+        "OneBot_url": "ws://127.0.0.1:8080",
+        "max_memo_size": 1024,
+        "ssl_check": True,
+        "webp": True,
+        "encrypt": {},
+        "profile_snapshot": str(tmp_path / "profile.json"),
+    })
@@ -0,0 +1,23 @@
+import asyncio
+
+from members import MemberIndex, MEMBER, ADMIN, OWNER
+
+
+def test_int_and_str_ids():
+    async def main():
+        index = MemberIndex()
+
+        async def loader():
+            return {"u0": OWNER, 1: MEMBER}
+
+        assert await index.roles(100, loader) == {"u0": OWNER, "1": MEMBER}
+        assert index.get("100") is index.get(100)
+        index.join("100", "u2")
+        index.set_role(100, 1, ADMIN)
+        index.leave(100, "u0")
+        assert index.get(100) == {"1": ADMIN, "u2": MEMBER}
+        assert await index.roles("100", loader) is index.get(100)
+        index.drop(100)
+        assert index.get("100") is None
+
+    asyncio.run(main())
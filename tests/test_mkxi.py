@@ -0,0 +1,82 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import mkxi
+from api import FetchAPI, GetMyProfile
+from model import MyProfile
+
+
+class FakeSupervisor:
+
+    def __init__(self, config, *callbacks):
+        self.mkix = self.onebot = None
+        self.health = SimpleNamespace(snapshot=lambda: {})
+        self.started = self.closed = False
+
+    async def start(self):
+        self.started = True
+
+    async def close(self):
+        self.closed = True
+
+
+def test_refresh_failure_keeps_snapshot(config, monkeypatch):
+    with open(config.profile_snapshot, "w", encoding="utf-8") as F:
+        F.write(MyProfile(uuid="1", username="snapshot", bio="", lastUpdate="",
+                          groups={"100"}, friends=set()).model_dump_json())
+    calls = []
+
+    async def call(self, cls, **kwargs):
+        if cls is not GetMyProfile:
+            raise RuntimeError("offline")
+        calls.append(cls)
+        if len(calls) == 1:
+            raise RuntimeError("offline")
+        return {"uuid": "1", "username": "fresh", "bio": "", "lastUpdate": "",
+                "groups": [{"group": "100"}, {"group": "101"}], "friends": []}
+
+    monkeypatch.setattr(mkxi, "WSSupervisor", FakeSupervisor)
+    monkeypatch.setattr(mkxi, "PROFILE_RETRY_DELAY", 0.01)
+    monkeypatch.setattr(FetchAPI, "call", call)
+
+    async def main():
+        bot = mkxi.Bot(config)
+        await bot._set_up()
+        assert bot._supervisor.started and not bot._supervisor.closed
+        assert bot._my_profile.username == "snapshot"
+        await asyncio.sleep(0.1)
+        assert len(calls) == 2
+        assert bot._my_profile.username == "fresh"
+        assert bot._my_profile.groups == {"100", "101"}
+
+    asyncio.run(main())
+    with open(config.profile_snapshot, "r", encoding="utf-8") as F:
+        assert MyProfile.model_validate_json(F.read()).username == "fresh"
+
+
+def test_shutdown_releases_account(config, monkeypatch):
+    async def call(self, cls, **kwargs):
+        raise RuntimeError("offline")
+
+    monkeypatch.setattr(mkxi, "WSSupervisor", FakeSupervisor)
+    monkeypatch.setattr(FetchAPI, "call", call)
+    with open(config.profile_snapshot, "w", encoding="utf-8") as F:
+        F.write(MyProfile(uuid="1", username="snapshot", bio="", lastUpdate="",
+                          groups=set(), friends=set()).model_dump_json())
+    callbacks = {k: list(v) for k, v in mkxi.metrics.QUEUE_DEPTH._callbacks.items()}
+
+    async def main():
+        bot = mkxi.Bot(config)
+        await bot._set_up()
+        bot._OneBotConnect = SimpleNamespace(drain=lambda timeout: asyncio.sleep(0, True))
+        background = set(bot._background)
+        assert background
+        await bot.shutdown(time.monotonic() + 1)
+        _, pending = await asyncio.wait({*background, bot._memo._consumer}, timeout=1)
+        assert not pending and bot._memo._consumer.cancelled()
+        assert bot._supervisor.closed
+
+    for _ in range(3):
+        asyncio.run(main())
+    assert mkxi.metrics.QUEUE_DEPTH._callbacks == callbacks
@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import itertools
+import threading
+import functools
+from weakref import WeakKeyDictionary
+from contextvars import ContextVar
+from collections import Counter
+from typing import Optional
+
+TRACE_FLUSH_SIZE = 1000     # 缓存达到该数量的span后写入文件
+PROFILE_SECONDS = 10        # 采样分析的时长，单位: s
+PROFILE_INTERVAL = 0.005    # 采样间隔，单位: s
+
+_enabled = False
+_path: Optional[str] = None
+_buffer: list[dict] = []
+_correlation: ContextVar[Optional[str]] = ContextVar("correlation", default=None)
+_task_ids: WeakKeyDictionary = WeakKeyDictionary()
+_task_counter = itertools.count(1)
+_profiling = False
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def configure(path: Optional[str]) -> None:
+    """ 设置path后开始记录span，输出为Chrome trace格式(chrome://tracing, Perfetto) """
+    global _enabled, _path
+    flush()
+    _enabled, _path = bool(path), path
+    if path and not os.path.exists(path):
+        with open(path, "w", encoding="utf-8") as F:
+            F.write("[\n")
+
+
+def correlate(correlation_id: Optional[str]) -> None:
+    """ 将当前协程及其创建的task中的span关联到同一个id """
+    _correlation.set(correlation_id)
+
+
+def current() -> Optional[str]:
+    return _correlation.get()
+
+
+def _tid() -> int:
+    # 每个task一行，避免交错的协程在同一行内重叠
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        return 0
+    if task not in _task_ids:
+        _task_ids[task] = next(_task_counter)
+    return _task_ids[task]
+
+
+class span:
+    """ with tracing.span("name", key=value) as s: s["result"] = ... """
+
+    def __init__(self, name: str, **args):
+        self._name = name
+        self._args = args
+
+    def __setitem__(self, key, value):
+        self._args[key] = value
+
+    def __enter__(self):
+        # 按进入时是否启用决定是否记录，期间重新加载配置开启或关闭时不影响
+        self._start = time.perf_counter_ns() if _enabled else None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._start is None:
+            return
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self._args["error"] = repr(exc)
+        correlation_id = _correlation.get()
+        if correlation_id is not None:
+            self._args["correlation"] = correlation_id
+        _buffer.append({
+            "name": self._name,
+            "ph": "X",
+            "ts": self._start // 1000,
+            "dur": (end - self._start) // 1000,
+            "pid": os.getpid(),
+            "tid": _tid(),
+            "args": self._args,
+        })
+        if len(_buffer) >= TRACE_FLUSH_SIZE:
+            flush()
+
+
+def traced(name: str):
+    """ 为函数增加span，未启用时只多一次判断 """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with span(name):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return func(*args, **kwargs)
+                with span(name):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def flush() -> None:
+    global _buffer
+    if not _buffer or not _path:
+        _buffer = []
+        return
+    events, _buffer = _buffer, []
+    with open(_path, "a", encoding="utf-8") as F:
+        F.writelines(json.dumps(i, ensure_ascii=False, default=str) + ",\n" for i in events)
+
+
+def profile(seconds: float = PROFILE_SECONDS, path: Optional[str] = None) -> Optional[str]:
+    """ 在后台线程对当前线程采样，输出折叠栈(flamegraph.pl, speedscope) """
+    global _profiling
+    if _profiling:
+        return None
+    _profiling = True
+    target = threading.get_ident()
+    path = path or f"profile-{int(time.time())}.folded"
+
+    def sample():
+        global _profiling
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(PROFILE_INTERVAL)
+        with open(path, "w", encoding="utf-8") as F:
+            F.writelines(f"{k} {v}\n" for k, v in stacks.most_common())
+        _profiling = False
+
+    threading.Thread(target=sample, name="profiler", daemon=True).start()
+    return path
@@ -0,0 +1,135 @@
+import os
+import math
+import base64
+import asyncio
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import log
+import metrics
+import tracing
+
+QUALITY_DEFAULT = 80        # Pillow的默认质量，大多数图片一次即可满足大小限制
+QUALITY_MIN = 40            # 低于该质量时改为缩小尺寸
+QUALITY_SEARCH_STEPS = 4    # 二分查找质量的最多次数
+DOWNSCALE_QUALITY = 70      # 缩小尺寸时使用的质量
+DOWNSCALE_STEPS = 5         # 缩小尺寸的最多次数
+DOWNSCALE_MARGIN = 0.9      # 按大小估算缩放比例后再乘以该系数，减少重试
+MIN_SIDE = 64               # 缩小后短边不小于该值，单位: px
+TRANSCODE_CACHE_SIZE = 256  # 记录最近的图片选用的参数
+
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="transcode")
+
+
+class Transcoder:
+    """ 在线程池中将图片转为webp，调整质量与尺寸使其不超过max_size，动图保留动画 """
+
+    _shared: dict[int, 'Transcoder'] = {}
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._params: OrderedDict[bytes, tuple[int, float]] = OrderedDict()  # 源图片hash -> (质量, 缩放比例)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, max_size: int) -> 'Transcoder':
+        """ 大小限制相同的账号共用参数缓存 """
+        if max_size not in cls._shared:
+            cls._shared[max_size] = cls(max_size)
+        return cls._shared[max_size]
+
+    async def __call__(self, s: str) -> str:
+        return await asyncio.get_running_loop().run_in_executor(_executor, self.transcode_blocking, s)
+
+    @tracing.traced("Transcoder.transcode")
+    def transcode_blocking(self, s: str) -> str:
+        from PIL import Image
+
+        try:
+            header, data = s.split(',', 1)
+            raw = base64.b64decode(data)
+            # 已是webp且足够小
+            if header.startswith("data:image/webp") and len(raw) <= self._max_size:
+                return s
+
+            key = hashlib.sha1(raw).digest()
+            with self._lock:
+                cached = self._params.get(key)
+            webp, quality, scale = self._search(Image.open(BytesIO(raw)), cached)
+            with self._lock:
+                self._params[key] = (quality, scale)
+                self._params.move_to_end(key)
+                if len(self._params) > TRANSCODE_CACHE_SIZE:
+                    self._params.popitem(last=False)
+
+            log.get_logger().info(f"Transcode image {len(raw)}B -> {len(webp)}B, quality={quality} scale={scale:.2f}")
+            if len(webp) > self._max_size:
+                log.get_logger().error(f"Image is still larger than {self._max_size}B after transcoding")
+            return "data:image/webp;base64," + base64.b64encode(webp).decode("utf-8")
+        except Exception as e:
+            log.get_logger().error(f"Convert image error: {e}")
+            return s
+
+    def _search(self, image, cached: tuple[int, float] = None) -> tuple[bytes, int, float]:
+        """ 返回 (webp, 质量, 缩放比例)，优先降低质量，其次缩小尺寸 """
+        if cached:
+            metrics.CACHE.inc("transcode", "hit")
+            webp = _encode(image, *cached)
+            if len(webp) <= self._max_size:
+                return webp, *cached
+        else:
+            metrics.CACHE.inc("transcode", "miss")
+
+        webp = _encode(image, QUALITY_DEFAULT, 1.0)
+        size = len(webp)
+        if size <= self._max_size:
+            return webp, QUALITY_DEFAULT, 1.0
+
+        # 二分查找满足大小的最高质量
+        best = None
+        low, high = QUALITY_MIN, QUALITY_DEFAULT - 1
+        for _ in range(QUALITY_SEARCH_STEPS):
+            if low > high:
+                break
+            quality = (low + high) // 2
+            webp = _encode(image, quality, 1.0)
+            if len(webp) <= self._max_size:
+                best, low = (webp, quality, 1.0), quality + 1
+            else:
+                high = quality - 1
+        if best:
+            return best
+
+        # 按默认质量下的大小估算缩放比例
+        scale = 1.0
+        min_scale = min(1.0, MIN_SIDE / max(1, min(image.size)))
+        for _ in range(DOWNSCALE_STEPS):
+            scale = max(min_scale, scale * math.sqrt(self._max_size / size) * DOWNSCALE_MARGIN)
+            webp = _encode(image, DOWNSCALE_QUALITY, scale)
+            size = len(webp)
+            if size <= self._max_size or scale == min_scale:
+                break
+        return webp, DOWNSCALE_QUALITY, scale
+
+
+def _encode(image, quality: int, scale: float) -> bytes:
+    from PIL import Image, ImageSequence
+
+    animated = getattr(image, "is_animated", False)
+    frames = [i.copy() for i in ImageSequence.Iterator(image)] if animated else [image]
+    durations = [i.info.get("duration", 100) for i in frames]
+    if scale < 1:
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        frames = [i.resize(size, Image.LANCZOS) for i in frames]
+
+    buffer = BytesIO()
+    if animated:
+        frames = [i.convert("RGBA") for i in frames]
+        frames[0].save(buffer, format="WEBP", quality=quality, save_all=True, append_images=frames[1:],
+                       duration=durations, loop=image.info.get("loop", 0))
+    else:
+        frames[0].save(buffer, format="WEBP", quality=quality)
+    return buffer.getvalue()
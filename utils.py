@@ -4,20 +4,20 @@ import json
 import base64
 import asyncio
 import logging
+import time
 import mimetypes
-from io import BytesIO
 from typing import Union, Literal, Optional, TYPE_CHECKING
 from datetime import datetime
+from contextvars import ContextVar
 from collections import deque
 from urllib.parse import urlparse
 
-from PIL import Image
-from rich.logging import RichHandler
-from Crypto.Cipher import AES
-from Crypto.Random import get_random_bytes
-from Crypto.Util.Padding import pad
-
+import log
+import metrics
+import tracing
 from api import PostFile, GetFile, FetchAPI
+from transcode import Transcoder
+from scheduler import Scheduler, lane_of
 from model import MkIXGetMessage, CQData, CQDataListItem, MkIXMessagePayload, MkIXPostMessage, Config, MkIXSystemMessage
 
 if TYPE_CHECKING:
@@ -26,58 +26,90 @@ if TYPE_CHECKING:
 TIME_LIMIT_TEXT = 1
 TIME_LIMIT_IMG = 3
 TIME_LIMIT_FILE = 10
+SLOW_ECHO_RATIO = 0.5       # echo耗时超过时限的该比例时视为服务器变慢
+DEDUPE_WINDOW = 300         # 重连后重复推送的消息在该时长内可被识别，单位: s
+DEDUPE_MAX_SIZE = 1 << 16   # 每代最多记录的消息数，超出后提前轮换
+
 
+class RecentKeys:
+    """ 两代轮换的集合，记录最近window秒内的key，内存不随运行时间增长 """
 
-class RichHandlerCut(RichHandler):
-    def emit(self, record):
-        if isinstance(record.msg, str) and len(record.msg) > 500:
-            record.msg = record.msg[:500] + "..."
-        super().emit(record)
+    def __init__(self, window: float = DEDUPE_WINDOW, max_size: int = DEDUPE_MAX_SIZE):
+        self._window = window
+        self._max_size = max_size
+        self._current: set = set()
+        self._previous: set = set()
+        self._rotated_at = time.monotonic()
 
+    def __len__(self):
+        return len(self._current) + len(self._previous)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-    handlers=[RichHandlerCut()]
-)
-logger = logging.getLogger("rich_logger")
-logger.setLevel(logging.INFO)
+    def add(self, key) -> bool:
+        """ key已存在时返回False """
+        now = time.monotonic()
+        if now - self._rotated_at >= self._window or len(self._current) >= self._max_size:
+            self._previous, self._current = self._current, set()
+            self._rotated_at = now
+        if key in self._current or key in self._previous:
+            return False
+        self._current.add(key)
+        return True
 
 
 class MkIXMessageMemo:
     """ 发送及确认消息，记录发送的消息id """
-    _instance = None
-
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = super(MkIXMessageMemo, cls).__new__(cls)
-        return cls._instance
+    _instance: ContextVar[Optional['MkIXMessageMemo']] = ContextVar("MkIXMessageMemo", default=None)  # 每个账号一个
 
     def __init__(self, config: Config):
-        if not hasattr(self, "_initialized"):
-            self._initialized = True
-            self._config = config
-            self._ws: Optional[MkIXConnect] = None
-            self._echo_id = 0
-            self._wait_echo: dict[int, asyncio.Future] = {}
-            self._message_chunk: dict[str, list[str]] = dict()  # message_id -> [message_id_0, message_id_1, ...]
-            self._message_group_type: dict[str, tuple[Literal["group", "friend"], str]] = dict()  # message_id -> (group_type, group_id)
-            self._message_queue = asyncio.Queue(maxsize=64)  # 消息队列
-            self._capacity_queue = deque()  # 到达最大记忆容量后pop过期数据，最大容量为config.max_memo_size
-            self._consumer = asyncio.create_task(self._dequeue())
+        if MkIXMessageMemo._instance.get() is not None:
+            raise ValueError("Already instantiated")
+        MkIXMessageMemo._instance.set(self)
+        self._config = config
+        self._ws: Optional[MkIXConnect] = None
+        self._echo_id = 0
+        self._wait_echo: dict[int, asyncio.Future] = {}
+        self._message_chunk: dict[str, list[str]] = dict()  # message_id -> [message_id_0, message_id_1, ...]
+        self._message_group_type: dict[str, tuple[Literal["group", "friend"], str]] = dict()  # message_id -> (group_type, group_id)
+        self._message_queue = Scheduler()  # 消息队列，按通道优先级及会话公平调度
+        self._capacity_queue = deque()  # 到达最大记忆容量后pop过期数据，最大容量为config.max_memo_size
+        self._received = RecentKeys()   # 收到的聊天消息，用于识别重连后重复推送的消息
+        self._transcoder = Transcoder.shared(config.image_max_size << 10)
+        self._consumer = asyncio.create_task(self._dequeue())
+        self._gauges = {
+            "send": self._message_queue.qsize,
+            "echo": lambda: len(self._wait_echo),
+            "memo": lambda: len(self._capacity_queue),
+            "dedupe": lambda: len(self._received),
+        }
+        for name, func in self._gauges.items():
+            metrics.QUEUE_DEPTH.add_function(name, func=func)
+
+    def close(self) -> None:
+        """ 停止发送队列的消费者，注销指标回调 """
+        self._consumer.cancel()
+        self._message_queue.close()
+        for name, func in self._gauges.items():
+            metrics.QUEUE_DEPTH.remove_function(name, func=func)
 
     @classmethod
     def get_instance(cls) -> 'MkIXMessageMemo':
-        if cls._instance:
-            return cls._instance
-        raise ValueError("Not instantiated yet")
+        instance = cls._instance.get()
+        if instance is None:
+            raise ValueError("Not instantiated yet")
+        return instance
+
+    def is_duplicate(self, message: dict) -> bool:
+        return not self._received.add((message.get("group"), message.get("time"), message.get("senderID")))
 
     def receive_chat(self, message: MkIXGetMessage, group_type: Literal["group", "friend"]) -> None:
         self._message_group_type[message.time] = (group_type, message.group)
         self._message_chunk[message.time] = [message.time]
         self._capacity_queue.append(message.time)
-        if len(self._capacity_queue) >= self._config.max_memo_size:
+        self._evict()
+
+    def _evict(self) -> None:
+        # max_memo_size调小后一次丢弃多出的部分
+        while self._capacity_queue and len(self._capacity_queue) >= self._config.max_memo_size:
             message_id = self._capacity_queue.popleft()
             if message_id in self._message_group_type:
                 del self._message_group_type[message_id]
@@ -85,6 +117,11 @@ class MkIXMessageMemo:
                 if i in self._message_chunk:
                     del self._message_chunk[i]
 
+    def reload(self) -> None:
+        """ config的字段更新后重建派生的结构 """
+        self._transcoder = Transcoder.shared(self._config.image_max_size << 10)
+        self._evict()
+
     def receive_echo(self, message: MkIXSystemMessage) -> None:
         echo = json.loads(message.payload)
         echo_id = echo["echo"]
@@ -106,16 +143,32 @@ class MkIXMessageMemo:
         return group_type, str(group_id), messages
 
     async def post_messages(self, messages: list[MkIXPostMessage], action: str, ws) -> dict:
-        self._ws = ws
-        future = asyncio.Future()
-        await self._message_queue.put((messages, future))
-        ret = await asyncio.wait_for(future, timeout=30)
+        message_ids = [i for i in await self._enqueue(messages, ws) if i]
+        ret = message_ids[0] if message_ids else -1
         mapping = {
             "send_private_forward_msg": {"message_id": ret, "forward_id": ret},
             "send_group_forward_msg": {"message_id": ret, "forward_id": ret},
         }
         return mapping.get(action, {"message_id": ret})
 
+    async def revoke_messages(self, batch: dict[str, list[MkIXPostMessage]], ws) -> dict[str, bool]:
+        """ 多条消息的撤回请求作为一批发送，返回每条消息是否撤回成功 """
+        if not batch:
+            return {}
+        results = iter(await self._enqueue([j for i in batch.values() for j in i], ws))
+        return {k: all([next(results) for _ in v]) for k, v in batch.items()}
+
+    async def _enqueue(self, messages: list[MkIXPostMessage], ws) -> list[Optional[str]]:
+        """ 返回每条消息的id，失败为None """
+        self._ws = ws
+        future = asyncio.Future()
+        await self._message_queue.put(
+            (messages, future, tracing.current()),
+            lane_of([i.type for i in messages]),
+            messages[0].group if messages else None,
+        )
+        return await asyncio.wait_for(future, timeout=30)
+
     async def _dequeue(self):
         while True:
             batch = await self._message_queue.get()
@@ -123,60 +176,87 @@ class MkIXMessageMemo:
                 await self._process_messages(batch)
             except Exception as e:
                 Tools.logger().error(f"Error processing messages: {e}")
-            finally:
-                self._message_queue.task_done()
 
-    async def _process_messages(self, batch: tuple[list[MkIXPostMessage], asyncio.Future]):
-        messages, future = batch
-        message_ids = []
-        for idx, i in enumerate(messages):
+    async def _process_messages(self, batch: tuple[list[MkIXPostMessage], asyncio.Future, Optional[str]]):
+        messages, future, correlation_id = batch
+        tracing.correlate(correlation_id)
+        with tracing.span("_process_messages") as span:
+            await self._send_messages(messages, future, span)
+
+    async def _send_messages(self, messages: list[MkIXPostMessage], future: asyncio.Future, span: tracing.span):
+        for i in messages:
             i.echo = self._echo_id
-            res = None
-            if i.type in ("file", "audio"):
-                fetcher = FetchAPI.get_instance()
-                try:
-                    res = await fetcher.call(
-                        PostFile,
-                        group=i.group,
-                        group_type=i.groupType,
-                        payload=i.payload.content,
-                        payload_type=i.type,
-                    )
-                    res = res["time"]
-                except Exception as e:
-                    Tools.logger().error(f"Upload File Error: {e}")
-            else:
-                if i.type == "image" and self._config.webp:
-                    i.payload.content = Tools.webp_b64(i.payload.content)
-                if i.type in ("text", "image") and i.group in self._config.encrypt:
-                    Tools.encrypt(self._config, i)
-                asyncio.create_task(self._ws.send(i.model_dump()))
-                res = await self._wait_for_echo(i.echo, Tools.time_limit(i.type))
-
-            if res:
-                Tools.logger().info(f"#{self._echo_id} Success")
-                message_ids.append(res)
-            else:
-                Tools.logger().error(f"#{self._echo_id} Failed")
             self._echo_id += 1
+        span["mkix_echo"] = [i.echo for i in messages]
+        if messages and all(i.type == "revokeRequest" for i in messages):
+            # 撤回请求互不依赖，连续发送后一起等待echo
+            results = list(await asyncio.gather(*[self._send_message(i) for i in messages]))
+        else:
+            results = [await self._send_message(i) for i in messages]
 
+        message_ids = [i for i in results if i]
         for i in message_ids:
             self._message_chunk[i] = message_ids
+        span["message_id"] = message_ids
 
-        success_count = len(message_ids)
-        if success_count == 0:
-            future.set_result(-1)
+        if not future.done():   # _enqueue已超时
+            future.set_result(results)
+        if not message_ids:
             raise Exception("Failed")
+
+    async def _send_message(self, i: MkIXPostMessage) -> Optional[str]:
+        res = None
+        if i.type in ("file", "audio"):
+            fetcher = FetchAPI.get_instance()
+            try:
+                res = await fetcher.call(
+                    PostFile,
+                    group=i.group,
+                    group_type=i.groupType,
+                    payload=i.payload.content,
+                    payload_type=i.type,
+                )
+                res = res["time"]
+            except Exception as e:
+                Tools.logger().error(f"Upload File Error: {e}")
         else:
-            future.set_result(message_ids[0])
+            if i.type == "image" and self._config.webp:
+                i.payload.content = await self._transcoder(i.payload.content)
+            if i.type in ("text", "image") and i.group in self._config.cipher:
+                await Tools.encrypt(self._config, i)
+            echo = self._wait_echo[i.echo] = asyncio.get_running_loop().create_future()
+            try:
+                spooled = await self._ws.send(i.model_dump())
+            except Exception as e:  # spool已满，不再等待echo
+                Tools.logger().error(f"#{i.echo} Send error: {e}")
+                self._wait_echo.pop(i.echo, None)
+            else:
+                if spooled is not None:     # 暂存的消息过期时立即失败，不等待echo超时
+                    spooled.add_done_callback(
+                        lambda f, echo=echo: echo.done() or f.exception() is None or echo.set_exception(f.exception()))
+                start = time.perf_counter()
+                with metrics.ECHO_RTT.time(i.type):
+                    res = await self._wait_for_echo(i.echo, echo, Tools.time_limit(i.type))
+                # echo超时或变慢说明服务器负载较高，降低发送速率；断线期间过期的消息不计
+                expired = spooled is not None and spooled.done() and spooled.exception() is not None
+                if not expired and (res is None or time.perf_counter() - start > Tools.time_limit(i.type) * SLOW_ECHO_RATIO):
+                    FetchAPI.get_instance().rate_limiter.throttle(i.group)
+
+        if res:
+            Tools.logger().info(f"#{i.echo} Success")
+        else:
+            Tools.logger().error(f"#{i.echo} Failed")
+        return res
 
-    async def _wait_for_echo(self, echo_id: int, time_limit: int) -> Optional[str]:
-        future = asyncio.Future()
-        self._wait_echo[echo_id] = future
+    async def _wait_for_echo(self, echo_id: int, future: asyncio.Future, time_limit: int) -> Optional[str]:
         try:
             return await asyncio.wait_for(future, timeout=time_limit)
-        except Exception as e:
-            Tools.logger().error(f"#{echo_id} Timeout: {e}")
+        except asyncio.TimeoutError:
+            Tools.logger().error(f"#{echo_id} Timeout")
+            del self._wait_echo[echo_id]
+            return None
+        except Exception as e:  # 暂存的消息已过期
+            Tools.logger().error(f"#{echo_id} Failed: {e}")
             del self._wait_echo[echo_id]
             return None
 
@@ -184,6 +264,7 @@ class MkIXMessageMemo:
 class CQCode:
 
     @classmethod
+    @tracing.traced("CQCode.serialization")
     def serialization(cls,
                       message: MkIXGetMessage,
                       config: Optional[Config] = None,
@@ -237,6 +318,7 @@ class CQCode:
         raise ValueError("Invalid parameter: format_type")
 
     @classmethod
+    @tracing.traced("CQCode.deserialization")
     async def deserialization(cls,
                               message: Union[CQData, list[CQDataListItem]],
                               auto_escape: bool = False) -> list[MkIXPostMessage]:
@@ -413,20 +495,21 @@ class CQCode:
 
 
 class RequestMemo:
-    _instance = None
+    _instance: ContextVar[Optional['RequestMemo']] = ContextVar("RequestMemo", default=None)  # 每个账号一个
 
     def __init__(self):
-        if RequestMemo._instance is not None:
+        if RequestMemo._instance.get() is not None:
             raise ValueError("Already instantiated")
         self._friend_request = dict()
         self._group_request = dict()
-        RequestMemo._instance = self
+        RequestMemo._instance.set(self)
 
     @classmethod
     def get_instance(cls) -> 'RequestMemo':
-        if cls._instance is None:
+        instance = cls._instance.get()
+        if instance is None:
             raise ValueError("Not instantiated yet")
-        return cls._instance
+        return instance
 
     def put(self, msg: MkIXSystemMessage):
         if msg.state == "等待审核" and msg.type == "join":
@@ -453,30 +536,11 @@ class Tools:
         return "{:.3f}".format(datetime.now().timestamp()).replace(".", "")
 
     @staticmethod
-    def encrypt(config: Config, msg: MkIXPostMessage) -> None:
-        s = msg.payload.content.encode('utf-8')
-        key = config.encrypt[msg.group].encode('utf-8')
-        iv = get_random_bytes(16)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        encrypted = cipher.encrypt(pad(s, 16))
-        encrypted = base64.b64encode(encrypted).decode('utf-8')
-
-        msg.payload.content = encrypted
+    @tracing.traced("Tools.encrypt")
+    async def encrypt(config: Config, msg: MkIXPostMessage) -> None:
+        msg.payload.content, iv = await config.cipher.encrypt(msg.group, msg.payload.content)
         msg.payload.meta["encrypt"] = True
-        msg.payload.meta["iv"] = iv.hex()
-
-    @staticmethod
-    def webp_b64(s: str) -> str:
-        try:
-            img = base64.b64decode(s.split(',')[1])
-            image = Image.open(BytesIO(img))
-            buffer = BytesIO()
-            image.save(buffer, format="WEBP")
-            webp = base64.b64encode(buffer.getvalue()).decode("utf-8")
-            return f"data:image/webp;base64,{webp}"
-        except Exception as e:
-            Tools.logger().error(f"Convert image error: {e}")
-            return s
+        msg.payload.meta["iv"] = iv
 
     @staticmethod
     def time_limit(t: str) -> int:
@@ -487,5 +551,5 @@ class Tools:
         return TIME_LIMIT_FILE
 
     @staticmethod
-    def logger():
-        return logger
+    def logger() -> logging.Logger:
+        return log.get_logger()
@@ -1,70 +1,305 @@
 import ssl
 import json
+import time
+import random
 import asyncio
 from abc import ABC, abstractmethod
+from collections import deque
 from math import inf
-from typing import Awaitable
+from typing import Awaitable, Callable, Literal, Optional
 
 import websockets
 
-from api import WSToken, FetchAPI
+import capture
+import metrics
+from api import WSToken, FetchAPI, UnauthorizedError, TOKEN_REFRESH_AHEAD, jwt_expire
 from utils import Tools
 from model import Config
 from event import LifeCycle, HeartBeat
 
 TIMEOUT = inf
-RETRY_INTERVAL = 5
+BACKOFF_BASE = 1        # 重连退避的初始间隔，单位: s
+BACKOFF_MAX = 60        # 重连退避的最大间隔，单位: s
+STABLE_INTERVAL = 30    # 连接保持超过该时长才重置退避，单位: s
+CIRCUIT_THRESHOLD = 5   # 连续鉴权失败达到该次数后熔断
+CIRCUIT_COOLDOWN = 300  # 熔断时长，单位: s
+WS_TOKEN_TTL = 60       # WSToken不是JWT且响应中没有expires_in时的复用时长，单位: s
 WS_FRAME_MAX_SIZE = 1 << 23  # 8MB
+SPOOL_MAX_SIZE = 256    # 断线期间最多暂存的消息数
+SPOOL_TTL = 10          # 暂存消息的有效期，单位: s
+
+
+class Backoff:
+    """ 带抖动的指数退避，避免多个实例同时重连 """
+
+    def __init__(self, base: float = BACKOFF_BASE, cap: float = BACKOFF_MAX):
+        self._base = base
+        self._cap = cap
+        self._attempt = 0
+
+    def next(self) -> float:
+        delay = random.uniform(0, min(self._cap, self._base * 2 ** self._attempt))
+        self._attempt += 1
+        return delay
+
+    def reset(self) -> None:
+        self._attempt = 0
+
+
+class Spool:
+    """ 连接断开时暂存待发送的消息，重连后按顺序发送，超过有效期仍未发送的消息被丢弃 """
+
+    def __init__(self, max_size: int = SPOOL_MAX_SIZE, ttl: float = SPOOL_TTL,
+                 on_empty: Optional[Callable[[], None]] = None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._on_empty = on_empty
+        self._buffer: deque[tuple[str, float, asyncio.Future]] = deque()  # (消息, 过期时间, 发送结果)
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _pop(self, error: Optional[Exception] = None) -> None:
+        _, _, future = self._buffer.popleft()
+        if not future.done():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        if not self._buffer and self._on_empty is not None:
+            self._on_empty()
+
+    def _expire(self) -> None:
+        # 所有消息的有效期相同，过期的消息总在队首
+        now = time.monotonic()
+        while self._buffer and self._buffer[0][1] <= now:
+            self._pop(RuntimeError(f"Spooled message expired after {self._ttl}s"))
+
+    def put(self, data: str) -> asyncio.Future:
+        """ 暂存后立即返回，发送后返回的future完成，过期时以异常完成；spool已满时抛出异常 """
+        self._expire()
+        if len(self._buffer) >= self._max_size:
+            raise RuntimeError("Spool is full")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())     # 无人等待时不报警告
+        self._buffer.append((data, time.monotonic() + self._ttl, future))
+        loop.call_later(self._ttl, self._expire)
+        return future
+
+    async def flush(self, ws) -> None:
+        self._expire()
+        while self._buffer:
+            await ws.send(self._buffer[0][0])  # 失败时留在队首，下次重连后再发送
+            self._pop()
+            self._expire()
 
 
 class WSConnect(ABC):
+    _name: str
 
     def __init__(self, config: Config, message_callback: Awaitable):
         self._ws = None
         self._ok = False
         self._config = config
         self._message_callback = message_callback
+        self._spool = Spool(on_empty=self._on_spool_empty)
+        self._backoff = Backoff()
+        self._task: Optional[asyncio.Task] = None
+        self._state: Literal["idle", "connecting", "connected", "backoff", "circuit_open"] = "idle"
+        self._connected_at = 0.0
+        self._reconnects = 0
+        self._auth_failures = 0
+        self._last_error: Optional[str] = None
+        self._last_active = 0.0     # 最近一次收到帧或ping成功的时间
+        self._sending = 0           # 正在发送或暂存的消息数
+        self._drained = asyncio.Event()
 
     @classmethod
     async def create(cls, config: Config, message_callback: Awaitable):
-        is_success = asyncio.Future()
         instance = cls(config, message_callback)
-        asyncio.create_task(instance._connect(is_success))
-        await asyncio.wait_for(is_success, inf)
+        await instance.start()
         return instance
 
+    async def start(self) -> None:
+        """ 启动连接循环，首次连接成功后返回 """
+        is_success = asyncio.Future()
+        self._task = asyncio.create_task(self._connect(is_success))
+        await asyncio.wait_for(is_success, TIMEOUT)
+
     @abstractmethod
-    async def _connect(self, future: asyncio.Future):
+    async def _open(self):
+        """ 返回websockets.connect(...) """
         pass
 
+    async def _on_open(self):
+        pass
+
+    async def _connect(self, future: asyncio.Future):
+        while True:
+            self._state = "connecting"
+            try:
+                async with await self._open() as websocket:
+                    Tools.logger().info(f"{self._name} Success")
+                    if not future.done():
+                        future.set_result(None)
+                    self._ws = websocket
+                    await self._spool.flush(websocket)
+                    self._ok = True
+                    self._state = "connected"
+                    self._connected_at = self._last_active = time.monotonic()
+                    self._auth_failures = 0
+                    await self._on_open()
+                    async for message in websocket:
+                        await self._on_message(message)
+            except websockets.ConnectionClosed as e:
+                await self._on_close(e)
+            except Exception as e:
+                if self._is_auth_error(e) and await self._on_auth_error():
+                    self._auth_failures += 1
+                await self._on_error(e)
+
+            if self._ok and time.monotonic() - self._connected_at >= STABLE_INTERVAL:
+                self._backoff.reset()
+            self._ok = False
+            self._reconnects += 1
+            metrics.RECONNECTS.inc(self._name)
+
+            if self._auth_failures >= CIRCUIT_THRESHOLD:
+                # 熔断，冷却后仅尝试一次，失败则再次熔断
+                self._state = "circuit_open"
+                delay = CIRCUIT_COOLDOWN + random.uniform(0, BACKOFF_MAX)
+                Tools.logger().error(f"{self._name} auth failed {self._auth_failures} times. Retrying in {delay:.1f}s...")
+            else:
+                self._state = "backoff"
+                delay = self._backoff.next()
+                Tools.logger().error(f"{self._name} Error. Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _is_auth_error(e: Exception) -> bool:
+        if isinstance(e, UnauthorizedError):
+            return True
+        if isinstance(e, websockets.InvalidStatus):
+            return e.response.status_code in (401, 403)
+        return False
+
+    async def _on_auth_error(self) -> bool:
+        """ 返回是否计入熔断 """
+        return True
+
     async def _on_message(self, message):
+        self._last_active = time.monotonic()
+        capture.record(self._name, message)
         message = json.loads(message)
         asyncio.create_task(self._message_callback(message))
 
     async def _on_close(self, e):
+        self._last_error = str(e)
         Tools.logger().error(f"WS closed: {e}")
 
     async def _on_error(self, e):
+        self._last_error = str(e)
         Tools.logger().error(f"WS error: {e}")
 
-    async def send(self, content):
-        if self._ws:
-            await self._ws.send(json.dumps(content))
+    def _on_spool_empty(self) -> None:
+        if not self._sending:
+            self._drained.set()
 
-    async def can_send(self) -> bool:
+    async def send(self, content) -> Optional[asyncio.Future]:
+        """ 连接断开时暂存并返回发送结果的future，消息过期时以异常完成 """
+        data = json.dumps(content)
+        self._sending += 1
+        self._drained.clear()
+        try:
+            if self._ok:
+                try:
+                    await self._ws.send(data)
+                    return
+                except websockets.ConnectionClosed:
+                    self._ok = False
+            # 连接断开时暂存，重连后发送
+            return self._spool.put(data)
+        finally:
+            self._sending -= 1
+            if not self._sending and not self._spool:
+                self._drained.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """ 等待正在发送及暂存的消息发送完毕，超时返回False """
+        if not self._sending and not self._spool:
+            return True
+        try:
+            await asyncio.wait_for(self._drained.wait(), max(0.0, timeout))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def close(self) -> None:
+        """ 停止重连并关闭连接 """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._ok = False
+        self._state = "idle"
+
+    async def ping(self, timeout: float) -> bool:
         try:
             waiter = await self._ws.ping()
-            await waiter
+            await asyncio.wait_for(waiter, timeout)
+            self._last_active = time.monotonic()
             return True
         except Exception:
             pass
         return False
 
+    def idle(self) -> float:
+        """ 距离最近一次活动的秒数 """
+        return time.monotonic() - self._last_active
+
+    def alive(self, interval: float) -> bool:
+        return self._ok and self.idle() < 3 * interval
+
+    def status(self) -> dict:
+        return {
+            "state": self._state,
+            "uptime": round(time.monotonic() - self._connected_at, 3) if self._ok else 0,
+            "reconnects": self._reconnects,
+            "auth_failures": self._auth_failures,
+            "spooled": len(self._spool),
+            "last_error": self._last_error,
+        }
+
 
 class MkIXConnect(WSConnect):
+    _name = "MkIXConnect"
 
-    async def _connect(self, future: asyncio.Future):
-        fetcher = FetchAPI.get_instance()
+    def __init__(self, config: Config, message_callback: Awaitable):
+        super().__init__(config, message_callback)
+        self._ws_token: Optional[str] = None
+        self._ws_token_expire = 0.0
+        self._ws_token_reused = False
+
+    async def _get_ws_token(self) -> str:
+        """ 未过期时复用WSToken，有效期取JWT中的exp或响应中的expires_in """
+        self._ws_token_reused = self._ws_token is not None and time.monotonic() < self._ws_token_expire
+        if not self._ws_token_reused:
+            metrics.CACHE.inc("ws_token", "miss")
+            res = await FetchAPI.get_instance().call(WSToken)
+            self._ws_token = res['token']
+            expire = jwt_expire(self._ws_token)
+            ttl = expire - time.time() - TOKEN_REFRESH_AHEAD if expire else res.get("expires_in", WS_TOKEN_TTL)
+            self._ws_token_expire = time.monotonic() + ttl
+        else:
+            metrics.CACHE.inc("ws_token", "hit")
+        return self._ws_token
+
+    async def _on_auth_error(self) -> bool:
+        # 复用的WSToken被拒绝时已失效，丢弃后重新获取，不计入熔断
+        reused, self._ws_token, self._ws_token_reused = self._ws_token_reused, None, False
+        return not reused
+
+    async def _open(self):
         url = f"{self._config.server_url.replace('http', 'ws')}/websocket/connect"
 
         ssl_context = None
@@ -73,70 +308,110 @@ class MkIXConnect(WSConnect):
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
 
-        while True:
-            try:
-                res = await fetcher.call(WSToken)
-                headers = {"Authorization": res['token']}
-                async with websockets.connect(url,
-                                              additional_headers=headers,
-                                              ssl=ssl_context,
-                                              max_size=WS_FRAME_MAX_SIZE) as websocket:
-                    Tools.logger().info("MkIXConnect Success")
-                    if not future.done():
-                        future.set_result(None)
-                    self._ok = True
-                    self._ws = websocket
-                    async for message in websocket:
-                        await self._on_message(message)
-            except websockets.ConnectionClosed as e:
-                await self._on_close(e)
-            except Exception as e:
-                await self._on_error(e)
-
-            Tools.logger().error("MkIXConnect Error. Retrying...")
-            self._ok = False
-            await asyncio.sleep(RETRY_INTERVAL)
+        headers = {"Authorization": await self._get_ws_token()}
+        return websockets.connect(url,
+                                  additional_headers=headers,
+                                  ssl=ssl_context,
+                                  max_size=WS_FRAME_MAX_SIZE)
 
 
 class OneBotConnect(WSConnect):
+    _name = "OneBotConnect"
 
-    async def _connect(self, future: asyncio.Future):
-        url = self._config.OneBot_url
+    def __init__(self, config: Config, message_callback: Awaitable):
+        super().__init__(config, message_callback)
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    async def _open(self):
         headers = {
             "X-Self-ID": self._config.account,
             "X-Client-Role": "Universal",
         }
+        return websockets.connect(self._config.OneBot_url,
+                                  additional_headers=headers,
+                                  max_size=WS_FRAME_MAX_SIZE)
 
-        while True:
-            try:
-                async with websockets.connect(url,
-                                              additional_headers=headers,
-                                              max_size=WS_FRAME_MAX_SIZE) as websocket:
-                    Tools.logger().info("OneBotConnect Success")
-                    if not future.done():
-                        future.set_result(None)
-                    self._ok = True
-                    self._ws = websocket
-                    asyncio.create_task(self._lifecycle())
-                    asyncio.create_task(self._heartbeat())
-                    async for message in self._ws:
-                        await self._on_message(message)
-            except websockets.ConnectionClosed as e:
-                await self._on_close(e)
-            except Exception as e:
-                await self._on_error(e)
-
-            Tools.logger().error("OneBotConnect Error. Retrying...")
-            self._ok = False
-            await asyncio.sleep(RETRY_INTERVAL)
+    async def _on_open(self):
+        asyncio.create_task(self._lifecycle())
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
 
     async def _lifecycle(self):
         content = await LifeCycle(self._config.account)()
         asyncio.create_task(self.send(content))
 
+    async def close(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        await super().close()
+
     async def _heartbeat(self):
+        interval = self._config.heartbeat_interval
         while True:
-            await asyncio.sleep(30)
+            await asyncio.sleep(interval)
             if self._ok:
-                content = await HeartBeat(self._config.account)()
+                content = await HeartBeat(self._config.account, interval)()
                 asyncio.create_task(self.send(content))
+
+
+class HealthMonitor:
+    """ 根据收到的帧判断连接是否存活，空闲时才ping，状态查询只读取缓存 """
+
+    def __init__(self, connects: list[WSConnect], interval: int):
+        self._connects = connects
+        self._interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await asyncio.gather(*[
+                i.ping(self._interval) for i in self._connects if i._ok and i.idle() >= self._interval
+            ])
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+    def snapshot(self) -> dict:
+        mkix, *others = self._connects
+        online = mkix.alive(self._interval)
+        return {
+            "online": online,
+            "good": online and all(i.alive(self._interval) for i in others),
+        }
+
+
+class WSSupervisor:
+    """ 管理Mk.IX与OneBot两端的连接 """
+
+    def __init__(self, config: Config, mkix_callback: Awaitable, onebot_callback: Awaitable):
+        self.mkix = MkIXConnect(config, mkix_callback)
+        self.onebot = OneBotConnect(config, onebot_callback)
+        self.health = HealthMonitor([self.mkix, self.onebot], config.heartbeat_interval)
+
+    @classmethod
+    async def create(cls, config: Config, mkix_callback: Awaitable, onebot_callback: Awaitable) -> 'WSSupervisor':
+        instance = cls(config, mkix_callback, onebot_callback)
+        await instance.start()
+        return instance
+
+    async def start(self) -> None:
+        """ 两端的连接互不依赖，同时建立 """
+        await asyncio.gather(self.mkix.start(), self.onebot.start())
+        self.health.start()
+
+    async def close(self) -> None:
+        self.health.stop()
+        await asyncio.gather(self.mkix.close(), self.onebot.close())
+
+    def status(self) -> dict:
+        return {
+            **self.health.snapshot(),
+            "mkix": self.mkix.status(),
+            "onebot": self.onebot.status(),
+        }